@@ -0,0 +1,157 @@
+import os
+import threading
+from functools import wraps
+from types import SimpleNamespace
+
+from flask import jsonify, request
+
+from timing import timed
+
+
+class Overloaded(Exception):
+    pass
+
+
+class AdmissionController:
+    """Bounds concurrent work in the expensive part of login and signup.
+
+    At most `max_in_flight` requests run the guarded code at once. Up to
+    `max_queue` more wait, each for at most `queue_timeout` seconds; anything
+    beyond that is answered immediately with 503 and Retry-After, so latency
+    for admitted requests stays flat under overload instead of every request
+    slowing down together.
+
+    The limits are per process until share_between_processes() is called;
+    serve.py does that in its master so all workers draw on one budget.
+    """
+
+    def __init__(self, max_in_flight, max_queue, queue_timeout, retry_after=1):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.admitted = 0
+        self.rejected = 0
+        self._slots = threading.Semaphore(max_in_flight)
+        self._waiting = SimpleNamespace(value=0)
+        self._lock = threading.Lock()
+        self._holders = None
+        self._row = None
+
+    def share_between_processes(self, max_processes=1024):
+        """Make the limits global to every process forked after this call.
+
+        Each process also records the slots it holds and the queue places it
+        takes in a shared table, so that release_process() can give back
+        whatever a worker held when it died (SIGKILL, OOM killer, crash).
+        """
+        import multiprocessing
+        self._slots = multiprocessing.Semaphore(self.max_in_flight)
+        self._waiting = multiprocessing.Value('i', 0)
+        self._lock = self._waiting.get_lock()
+        # (pid, held slots, queued requests) per process, guarded by _lock
+        self._holders = multiprocessing.Array('q', 3 * max_processes, lock=False)
+
+    def _track(self, held=0, waiting=0):
+        # Caller holds _lock
+        table = self._holders
+        if table is None:
+            return
+        pid = os.getpid()
+        if self._row is None or self._row[0] != pid:
+            rows = range(0, len(table), 3)
+            row = next((i for i in rows if table[i] == pid), None)
+            if row is None:
+                row = next((i for i in rows if table[i] == 0), None)
+                if row is None:
+                    return  # table full: this process goes untracked
+                table[row] = pid
+            self._row = (pid, row)
+        row = self._row[1]
+        table[row + 1] += held
+        table[row + 2] += waiting
+
+    def release_process(self, pid):
+        """Give back the slots and queue places a dead process still held.
+
+        serve.py's master calls this for every worker it reaps. Returns the
+        number of slots released.
+        """
+        table = self._holders
+        if table is None:
+            return 0
+        with self._lock:
+            row = next((i for i in range(0, len(table), 3) if table[i] == pid), None)
+            if row is None:
+                return 0
+            held, waiting = table[row + 1], table[row + 2]
+            table[row:row + 3] = [0, 0, 0]
+            self._waiting.value -= waiting
+        for _ in range(held):
+            self._slots.release()
+        return held
+
+    def acquire(self):
+        if self._slots.acquire(False):
+            if self._holders is not None:
+                with self._lock:
+                    self._track(held=1)
+            self.admitted += 1
+            return
+        with self._lock:
+            if self._waiting.value >= self.max_queue:
+                self.rejected += 1
+                raise Overloaded()
+            self._waiting.value += 1
+            self._track(waiting=1)
+        acquired = False
+        try:
+            with timed('queue'):
+                acquired = self._slots.acquire(timeout=self.queue_timeout)
+        finally:
+            with self._lock:
+                self._waiting.value -= 1
+                self._track(held=1 if acquired else 0, waiting=-1)
+        if not acquired:
+            self.rejected += 1
+            raise Overloaded()
+        self.admitted += 1
+
+    def release(self):
+        if self._holders is not None:
+            with self._lock:
+                self._track(held=-1)
+        self._slots.release()
+
+    def guard(self, view):
+        # Admission applies to form submissions; page loads are never queued
+        @wraps(view)
+        def guarded(*args, **kwargs):
+            if request.method != 'POST':
+                return view(*args, **kwargs)
+            self.acquire()
+            try:
+                return view(*args, **kwargs)
+            finally:
+                self.release()
+        return guarded
+
+    def init_app(self, app):
+        @app.errorhandler(Overloaded)
+        def overloaded(error):
+            response = jsonify({
+                "success": False,
+                "message": "Server is busy. Please try again shortly.",
+                "overloaded": True,
+            })
+            response.status_code = 503
+            response.headers['Retry-After'] = str(self.retry_after)
+            return response
+
+    def stats(self):
+        return {
+            'in_flight_limit': self.max_in_flight,
+            'waiting': self._waiting.value,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+        }
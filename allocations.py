@@ -0,0 +1,222 @@
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from flask import abort, g, has_request_context, jsonify, request
+
+# Opt-in per-stage allocation tracking with tracemalloc. Each timed() stage
+# also records how far traced memory rose above its starting point, requests
+# whose peak exceeds the budget are logged next to the timing lines, and the
+# allocation sites of stages on over-budget endpoints are aggregated for
+# /admin/allocations. tracemalloc counts the whole process, so per-request
+# numbers are exact only while one tracked request runs per process (e.g.
+# ADMISSION_MAX_IN_FLIGHT=1 under serve.py); overlapping requests blur together.
+
+logger = logging.getLogger('smartlogin.timing')  # shares the timing log
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+tracker = None
+
+
+class AllocationTracker:
+    """Aggregates tracemalloc peaks per (endpoint, stage) and top sites.
+
+    Snapshots are expensive, so sites are only sampled for endpoints that
+    have gone over `budget`, at most once every `site_interval` seconds per
+    stage, by diffing snapshots taken as the stage starts and ends. That
+    shows what the stage still holds when it ends (base64 copies, NumPy
+    arrays); temporaries freed inside the stage only show up in its peak.
+    PIL allocates pixel buffers outside Python's allocator, so decoded
+    images are not traced at all.
+    """
+
+    def __init__(self, budget, frames=16, top_n=20, site_interval=60.0):
+        self.budget = budget
+        self.frames = frames
+        self.top_n = top_n
+        self.site_interval = site_interval
+        self.requests = 0
+        self.over_budget = 0
+        self._stages = {}
+        self._sites = {}
+        self._over_budget_endpoints = set()
+        self._next_site_sample = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+
+    def should_sample(self, endpoint, stage):
+        key = (endpoint, stage)
+        now = time.monotonic()
+        with self._lock:
+            if endpoint not in self._over_budget_endpoints or now < self._next_site_sample.get(key, 0):
+                return False
+            self._next_site_sample[key] = now + self.site_interval
+            return True
+
+    def stage_finished(self, endpoint, stage, peak):
+        with self._lock:
+            stats = self._stages.setdefault((endpoint, stage), [0, 0, 0])
+            stats[0] += 1
+            stats[1] += peak
+            stats[2] = max(stats[2], peak)
+
+    def collect_sites(self, endpoint, stage, before):
+        grown = []
+        for diff in tracemalloc.take_snapshot().compare_to(before, 'traceback'):
+            if diff.size_diff <= 0:
+                continue
+            # Skip the bookkeeping of the snapshot taken at stage start
+            if any(frame.filename == __file__ for frame in diff.traceback):
+                continue
+            grown.append(diff)
+            if len(grown) == self.top_n:
+                break
+        with self._lock:
+            for diff in grown:
+                key = (endpoint, stage, _frame_name(diff.traceback[-1]), _caller(diff.traceback))
+                site = self._sites.setdefault(key, [0, 0])
+                site[0] += 1
+                site[1] += diff.size_diff
+
+    def request_finished(self, endpoint, status, peak, stage_peaks):
+        with self._lock:
+            self.requests += 1
+            over = peak > self.budget
+            if over:
+                self.over_budget += 1
+                self._over_budget_endpoints.add(endpoint)
+        if over:
+            logger.warning(json.dumps({
+                'event': 'allocation_budget',
+                'endpoint': endpoint,
+                'status': status,
+                'peak_bytes': peak,
+                'budget_bytes': self.budget,
+                'stages_bytes': stage_peaks,
+            }))
+
+    def report(self, top_n=None):
+        current, _ = tracemalloc.get_traced_memory()
+        with self._lock:
+            stages = {}
+            for (endpoint, stage), (count, total, largest) in sorted(self._stages.items()):
+                stages.setdefault(endpoint, {})[stage] = {
+                    'count': count,
+                    'mean_peak_bytes': total // count,
+                    'max_peak_bytes': largest,
+                }
+            sites = sorted(self._sites.items(), key=lambda item: item[1][1], reverse=True)
+            return {
+                'tracing': tracemalloc.is_tracing(),
+                'traced_bytes': current,
+                'budget_bytes': self.budget,
+                'requests': self.requests,
+                'over_budget': self.over_budget,
+                'stages': stages,
+                'sites': [
+                    {
+                        'endpoint': endpoint,
+                        'stage': stage,
+                        'site': site,
+                        'caller': caller,
+                        'samples': samples,
+                        'bytes': size,
+                    }
+                    for (endpoint, stage, site, caller), (samples, size) in sites[:top_n or self.top_n]
+                ],
+            }
+
+
+def _frame_name(frame):
+    filename = frame.filename
+    if filename.startswith(APP_ROOT):
+        filename = os.path.relpath(filename, APP_ROOT)
+    return f'{filename}:{frame.lineno}'
+
+
+def _caller(traceback):
+    # Innermost frame in our own code, e.g. the dev.py line that called PIL
+    for frame in reversed(traceback):
+        if frame.filename.startswith(APP_ROOT):
+            return _frame_name(frame)
+    return None
+
+
+def _fold(stack):
+    # The peak counter is process-wide and reset at every stage boundary,
+    # so fold it into every open frame before resetting it
+    current, peak = tracemalloc.get_traced_memory()
+    for frame in stack:
+        if peak > frame[1]:
+            frame[1] = peak
+    tracemalloc.reset_peak()
+    return current
+
+
+@contextmanager
+def stage(name):
+    stack = g.get('allocation_stack') if has_request_context() else None
+    if stack is None:
+        yield
+        return
+    endpoint = request.endpoint
+    before = tracemalloc.take_snapshot() if tracker.should_sample(endpoint, name) else None
+    current = _fold(stack)
+    frame = [current, current]
+    stack.append(frame)
+    try:
+        yield
+    finally:
+        _fold(stack)
+        stack.pop()
+        peak = frame[1] - frame[0]
+        peaks = g.allocation_peaks
+        peaks[name] = max(peaks.get(name, 0), peak)
+        tracker.stage_finished(endpoint, name, peak)
+        if before is not None:
+            tracker.collect_sites(endpoint, name, before)
+            # Keep the snapshots out of the enclosing request's peak
+            tracemalloc.reset_peak()
+
+
+def init_app(app, endpoints):
+    global tracker
+    if not app.config.get('ALLOCATION_TRACKING'):
+        return
+    tracker = AllocationTracker(app.config['ALLOCATION_BUDGET'])
+    tracker.start()
+
+    @app.before_request
+    def start_allocation_tracking():
+        if request.endpoint in endpoints:
+            g.allocation_stack = []
+            current = _fold(g.allocation_stack)
+            g.allocation_stack.append([current, current])
+            g.allocation_peaks = {}
+
+    @app.after_request
+    def finish_allocation_tracking(response):
+        stack = g.pop('allocation_stack', None)
+        if stack:
+            _fold(stack)
+            tracker.request_finished(request.endpoint, response.status_code,
+                                     stack[0][1] - stack[0][0], g.allocation_peaks)
+        return response
+
+    @app.route('/admin/allocations')
+    def allocation_report():
+        # Needs ADMIN_TOKEN in the X-Admin-Token header; hidden when unset
+        token = app.config.get('ADMIN_TOKEN')
+        supplied = request.headers.get('X-Admin-Token', '').encode('utf-8')
+        if not token or not hmac.compare_digest(supplied, token.encode('utf-8')):
+            abort(404)
+        return jsonify(tracker.report(request.args.get('top', type=int)))
@@ -0,0 +1,159 @@
+import atexit
+import gzip
+import json
+import os
+import shutil
+import threading
+import time
+from collections import deque
+
+try:
+    import fcntl
+except ImportError:  # Windows: rotation is not coordinated between processes
+    fcntl = None
+
+
+class AuditLog:
+    """Append-only JSON-lines log of authentication events.
+
+    record() only appends a tuple to an in-memory buffer; a background
+    thread formats and writes the buffer in batches every `flush_interval`
+    seconds or as soon as `batch_size` events are queued. When the buffer
+    holds `capacity` events, new events are dropped and counted instead of
+    blocking the request. Files are rotated at `max_bytes`, keeping
+    `backups` gzip-compressed generations.
+    """
+
+    def __init__(self, path, capacity=65536, batch_size=512, flush_interval=1.0,
+                 max_bytes=50 * 1024 * 1024, backups=5, compress=True):
+        self.path = path
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.compress = compress
+
+        self.dropped = 0
+        self.written = 0
+        self._buffer = deque()
+        self._wakeup = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._file = None
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        atexit.register(self.flush)
+        # The writer thread does not survive fork(); each worker starts its own
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._buffer.clear()
+        self._thread = None
+        self._file = None
+        self._wakeup = threading.Event()
+        self._flush_lock = threading.Lock()
+        self.dropped = 0
+        self.written = 0
+
+    def record(self, event, username, success, reason=None):
+        buffer = self._buffer
+        if len(buffer) >= self.capacity:
+            self.dropped += 1
+            return
+        buffer.append((time.time(), event, username, success, reason))
+        if self._thread is None:
+            self._start()
+        elif len(buffer) == self.batch_size:
+            self._wakeup.set()
+
+    def _start(self):
+        with self._flush_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='audit-log', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"Audit log write error: {e}")
+
+    def flush(self):
+        with self._flush_lock:
+            buffer = self._buffer
+            lines = []
+            # Only what is queued now, so a busy producer cannot stretch one batch
+            for _ in range(len(buffer)):
+                timestamp, event, username, success, reason = buffer.popleft()
+                lines.append(json.dumps({
+                    'ts': round(timestamp, 6),
+                    'event': event,
+                    'username': username,
+                    'success': success,
+                    'reason': reason,
+                }))
+            if not lines:
+                return
+            data = ('\n'.join(lines) + '\n').encode('utf-8')
+            f = self._open()
+            # One write() per batch; O_APPEND keeps workers from overwriting each other
+            f.write(data)
+            f.flush()
+            self.written += len(lines)
+            if f.tell() >= self.max_bytes:
+                self._rotate()
+
+    def close(self):
+        # Write out whatever is still buffered; callers that leave through
+        # os._exit() (serve.py workers) skip the atexit hook
+        self.flush()
+        with self._flush_lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _open(self):
+        # Reopen when another process rotated the file underneath us
+        if self._file is not None:
+            try:
+                if os.stat(self.path).st_ino == os.fstat(self._file.fileno()).st_ino:
+                    return self._file
+            except FileNotFoundError:
+                pass
+            self._file.close()
+        self._file = open(self.path, 'ab')
+        return self._file
+
+    def _rotate(self):
+        with open(self.path + '.lock', 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # Another process may have rotated while we waited for the lock
+            if os.path.getsize(self.path) < self.max_bytes:
+                return
+            suffix = '.gz' if self.compress else ''
+            for generation in range(self.backups - 1, 0, -1):
+                source = f'{self.path}.{generation}{suffix}'
+                if os.path.exists(source):
+                    os.replace(source, f'{self.path}.{generation + 1}{suffix}')
+            rotated = f'{self.path}.1'
+            os.replace(self.path, rotated)
+            self._file.close()
+            self._file = None
+            if self.compress:
+                with open(rotated, 'rb') as src, gzip.open(rotated + '.gz', 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+                os.remove(rotated)
+
+    def stats(self):
+        return {
+            'queued': len(self._buffer),
+            'written': self.written,
+            'dropped': self.dropped,
+        }
@@ -0,0 +1,102 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from loadtest import enroll, generate_face, post, start_server, to_data_url
+
+# Cold start of a fresh server: time from launching serve.py to its first
+# successful face login (what a newly autoscaled instance costs), the
+# latency of that first login and of a warm one, plus an -X importtime
+# audit of `import dev`.
+#
+#   python bench_coldstart.py --runs 5 --importtime 15
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def import_audit(top):
+    # Cumulative import time of everything `import dev` pulls in, shallowest
+    # modules first so the expensive top-level imports stand out
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import dev'],
+        cwd=ROOT, capture_output=True, text=True, check=True,
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append((int(cumulative), depth, name.strip()))
+    total = next(cumulative for cumulative, _, name in rows if name == 'dev')
+    print(f'import dev: {total / 1000:.1f} ms')
+    for cumulative, depth, name in sorted((row for row in rows if 1 <= row[1] <= 2), reverse=True)[:top]:
+        print(f'  {cumulative / 1000:7.1f} ms  {"  " * depth}{name}')
+
+
+def first_login(port, fields, warm_fields, timeout):
+    # Launch a fresh server and poll until a login succeeds
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'serve.py'), '--port', str(port), '--workers', '1'],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = started + timeout
+        while time.perf_counter() < deadline:
+            request_started = time.perf_counter()
+            try:
+                status, body = post(f'http://127.0.0.1:{port}/login', fields, timeout)
+            except OSError:
+                time.sleep(0.005)
+                continue
+            if status == 200 and body and body.get('success'):
+                finished = time.perf_counter()
+                # A different frame, so the warm login misses the result cache
+                post(f'http://127.0.0.1:{port}/login', warm_fields, timeout)
+                warm = time.perf_counter() - finished
+                return finished - started, finished - request_started, warm
+        raise RuntimeError(f'No successful login within {timeout}s')
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time to first successful login of a fresh server')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--port', type=int, default=5066)
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--importtime', type=int, default=0, metavar='N',
+                        help='Also list the N slowest imports of `import dev`')
+    args = parser.parse_args()
+
+    if args.importtime:
+        import_audit(args.importtime)
+
+    os.chdir(tempfile.mkdtemp(prefix='bench_coldstart_'))
+    server = start_server(args.port, 'serve', 1)
+    try:
+        (seed, username, password), = enroll(f'http://127.0.0.1:{args.port}', 1, 'cold', args.timeout)
+    finally:
+        server.terminate()
+        server.wait()
+    fields, warm_fields = (
+        {'username': username, 'password': password, 'image': to_data_url(generate_face(seed, capture=capture))}
+        for capture in (1, 2)
+    )
+
+    samples = [first_login(args.port, fields, warm_fields, args.timeout) for _ in range(args.runs)]
+    print(f'{"":>24} {"median ms":>10} {"min ms":>8}')
+    for label, values in zip(('time to first login', 'first login request', 'warm login request'), zip(*samples)):
+        values = [value * 1000 for value in values]
+        print(f'{label:>24} {statistics.median(values):>10.1f} {min(values):>8.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# Login comparison latency as a function of gallery size K: one broadcast
+# over the stacked (K, H, W, C) gallery versus K separate comparisons, each
+# decoding the probe and a stored JPEG as before galleries existed.
+#
+#   python bench_gallery.py --max-k 8
+
+
+def best_of(repeats, func):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Gallery comparison latency by K')
+    parser.add_argument('--max-k', type=int, default=8)
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix='bench_gallery_'))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import dev
+    from loadtest import generate_face, to_data_url
+
+    references = [to_data_url(generate_face(i)) for i in range(args.max_k)]
+    probe = to_data_url(generate_face(0))
+    paths = [dev.save_image(reference, f'ref{i}') for i, reference in enumerate(references)]
+    dev.app.config['GALLERY_SIZE'] = args.max_k
+
+    print(f'{"K":>3} {"stacked ms":>11} {"separate ms":>12}')
+    for k in range(1, args.max_k + 1):
+        dev.template_store.put('gallery', np.stack([dev.template_store.get(f'ref{i}')[0] for i in range(k)]))
+        stack = dev.template_store.get('gallery')
+        stacked = best_of(args.repeats, lambda: dev.compare_images(None, probe, stack))
+        separate = best_of(args.repeats, lambda: [dev.compare_images(path, probe) for path in paths[:k]])
+        print(f'{k:>3} {stacked:>11.3f} {separate:>12.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,162 +1,563 @@
 import os
 import base64
+import hashlib
+import importlib.util
 import json
 from io import BytesIO
 from flask import Flask, render_template, request, jsonify, redirect, url_for, session
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
 from PIL import Image
 import re
+import time
 import numpy as np
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from template_store import TemplateStore, TEMPLATE_SHAPE
+import timing
+from timing import timed
+import allocations
+from quality import check_frame
+import enrollment
+from user_registry import UserRegistry
+from audit import AuditLog
+from trusted_devices import TrustedDevices, SingleUseIds
+from result_cache import ResultCache, payload_digest
+from admission import AdmissionController, Overloaded
 
 app = Flask(__name__)
 app.secret_key = 'your_secret_key_here'
 app.config['UPLOAD_FOLDER'] = 'uploads'
+app.config['TEMPLATE_STORE'] = 'template_store'
+app.config['USER_FOLDER'] = 'users'
+app.config['AUDIT_LOG'] = os.path.join('logs', 'audit.log')
+app.config['TIMING_LOG'] = os.environ.get('SMARTLOGIN_TIMING_LOG')  # stderr when unset
+app.config['QUALITY_GATE'] = {}  # overrides for quality.DEFAULT_THRESHOLDS
+app.config['ENROLLMENT_IMAGE'] = {}  # overrides for enrollment.DEFAULT_SPEC
+app.config['TRUSTED_DEVICE_WINDOW'] = 0  # seconds a face match is trusted per device; 0 disables
+app.config['RESULT_CACHE_SIZE'] = 4096  # remembered comparison verdicts
+app.config['RESULT_CACHE_TTL'] = 120  # seconds
+app.config['GALLERY_SIZE'] = 5  # reference images kept per user
+app.config['ADMISSION_MAX_IN_FLIGHT'] = os.cpu_count() or 1  # concurrent logins/signups doing real work
+app.config['ADMISSION_MAX_QUEUE'] = 2 * (os.cpu_count() or 1)  # requests allowed to wait for a slot
+app.config['ADMISSION_QUEUE_TIMEOUT'] = 2.0  # seconds a request may wait before a 503
+app.config['ADMISSION_RETRY_AFTER'] = 1  # seconds, sent as Retry-After
+app.config['STREAM_MIN_FRAMES'] = 2  # frames scored before a streamed login can pass
+app.config['STREAM_MAX_FRAMES'] = 40
+app.config['STREAM_TIMEOUT'] = 15  # seconds per streamed verification
+app.config['STREAM_SMOOTHING'] = 0.5  # weight of the newest frame in the running score
+app.config['STREAM_TICKET_FOLDER'] = 'stream_tickets'  # redeemed tickets, shared by worker processes
+app.config['ALLOCATION_TRACKING'] = bool(os.environ.get('SMARTLOGIN_TRACEMALLOC'))  # slows every request
+app.config['ALLOCATION_BUDGET'] = 64 * 1024 * 1024  # bytes; requests peaking above this are logged
+app.config['ADMIN_TOKEN'] = os.environ.get('SMARTLOGIN_ADMIN_TOKEN')  # X-Admin-Token for /admin/*; unset disables
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-# In-memory user storage (no default user)
-users = {}
+# Server-Timing header and timing log line for the authentication endpoints
+timing.init_app(app, endpoints={'login', 'signup', 'enroll'})
+
+# Opt-in tracemalloc peaks per stage, budget warnings and /admin/allocations
+allocations.init_app(app, endpoints={'login', 'signup', 'enroll'})
+
+# Sheds load with 503 + Retry-After once the image pipeline is saturated
+admission = AdmissionController(
+    app.config['ADMISSION_MAX_IN_FLIGHT'],
+    app.config['ADMISSION_MAX_QUEUE'],
+    app.config['ADMISSION_QUEUE_TIMEOUT'],
+    app.config['ADMISSION_RETRY_AFTER'],
+)
+admission.init_app(app)
+
+# User storage (no default user), shared by worker processes through USER_FOLDER
+users = UserRegistry(folder=app.config['USER_FOLDER'])
+
+# Signup and login outcomes, written in batches by a background thread
+audit_log = AuditLog(app.config['AUDIT_LOG'])
+
+# Signed device tokens that skip the face check after a recent match
+trusted_devices = TrustedDevices(app.secret_key)
+
+# Verdicts for frames that were already compared, for resubmitted captures
+result_cache = ResultCache(app.config['RESULT_CACHE_SIZE'], app.config['RESULT_CACHE_TTL'])
+
+# Streaming face verification over a WebSocket (needs flask-sock). The
+# package is only imported with the first stream, see login_stream_route()
+stream_login_available = importlib.util.find_spec('flask_sock') is not None
+stream_tickets = URLSafeTimedSerializer(app.secret_key, salt='stream-login')
+STREAM_TICKET_TTL = 30  # seconds to redeem a ticket at /login/stream/complete
+used_stream_tickets = SingleUseIds(app.config['STREAM_TICKET_FOLDER'], STREAM_TICKET_TTL)
+
+# Normalized comparison arrays for every enrolled user in one memory-mapped file
+template_store = TemplateStore(app.config['TEMPLATE_STORE'])
+
+# Percentage of similar pixels needed for a face match
+MATCH_THRESHOLD = 10
 
 def validate_email(email):
     pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
     return re.match(pattern, email) is not None
 
-def save_image(base64_string, username):
-    # Remove data URL prefix
-    base64_data = base64_string.split(',')[1]
+def normalize_image(image):
+    # Convert to the fixed size and format used for comparison
+    height, width = TEMPLATE_SHAPE[:2]
+    return np.array(image.convert('RGB').resize((width, height)))
+
+def decode_data_url(data_url):
+    with timed('b64'):
+        # Remove data URL prefix and decode base64
+        return base64.b64decode(data_url.split(',')[1])
+
+def auth_response(event, username, success, message, **extra):
+    # Every signup/login outcome goes through here so it reaches the audit log
+    audit_log.record(event, username, success, message)
+    return jsonify({"success": success, "message": message, **extra})
+
+def check_capture(image_data):
+    # Reject unusable frames from a small grayscale copy before full decoding
+    # Returns (image_bytes, None) or (None, (message, extra response fields))
+    try:
+        image_bytes = decode_data_url(image_data)
+    except Exception:
+        return None, ("Invalid image data", {"retry": True})
     
-    # Decode base64
-    image_data = base64.b64decode(base64_data)
+    with timed('quality'):
+        problem = check_frame(image_bytes, app.config['QUALITY_GATE'])
+    if problem:
+        reason, message = problem
+        return None, (message, {"reason": reason, "retry": True})
+    return image_bytes, None
+
+def add_reference(username, image_data):
+    # Add one more reference frame to the user's gallery
+    with timed('decode'):
+        template = normalize_image(Image.open(BytesIO(image_data)))
+    with timed('storage'):
+        template_store.add(username, template, app.config['GALLERY_SIZE'])
+        result_cache.invalidate_user(username)
+    return len(template_store.get(username))
+
+def upload_name(username, extension):
+    # Named by hash like users/ files: secure_filename() maps distinct names
+    # ('李' and '王', 'a b' and 'a_b') to one file
+    return hashlib.sha256(username.encode('utf-8')).hexdigest() + extension
+
+def save_image(base64_string, username, image_data=None, references=()):
+    # Decode base64 unless the caller already did
+    if image_data is None:
+        image_data = decode_data_url(base64_string)
     
-    # Process image with PIL for better quality
-    image = Image.open(BytesIO(image_data))
+    with timed('decode'):
+        # Process image with PIL for better quality
+        image = Image.open(BytesIO(image_data))
+        
+        template = normalize_image(image)
     
-    # Convert to RGB if needed
-    if image.mode != 'RGB':
-        image = image.convert('RGB')
+    spec = enrollment.resolve_spec(app.config['ENROLLMENT_IMAGE'])
+    with timed('encode'):
+        # Encode in the configured enrollment format
+        encoded, extension = enrollment.encode(image, spec)
     
-    # Save image with high quality
-    filename = secure_filename(f"{username}.jpg")
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    image.save(filepath, 'JPEG', quality=95)
+    with timed('storage'):
+        filename = upload_name(username, extension)
+        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        with open(filepath, 'wb') as f:
+            f.write(encoded)
+        
+        # Optionally keep the captured bytes untouched in cold storage
+        if spec['keep_original']:
+            original_extension = enrollment.FORMATS.get(image.format or 'JPEG', '.jpg')
+            enrollment.keep_original(image_data, upload_name(username, original_extension), spec)
+        
+        # Keep the normalized templates so logins skip the JPEG decode
+        template_store.put(username, np.stack([template, *references]))
+        result_cache.invalidate_user(username)
     
     return filepath
 
-def compare_images(image1_path, image2_base64):
+def compare_images(image1_path, image2_base64, stored_array=None, captured_bytes=None):
     try:
-        # Process stored image
-        with open(image1_path, 'rb') as f:
-            stored_image = Image.open(BytesIO(f.read()))
+        # Process stored image unless its template is already loaded
+        if stored_array is None:
+            with timed('storage'):
+                with open(image1_path, 'rb') as f:
+                    stored_bytes = f.read()
+            with timed('decode'):
+                stored_array = normalize_image(enrollment.decode(stored_bytes, image1_path))
         
         # Process captured image
-        base2_data = image2_base64.split(',')[1]
-        captured_image = Image.open(BytesIO(base64.b64decode(base2_data)))
+        if captured_bytes is None:
+            captured_bytes = decode_data_url(image2_base64)
         
         # Convert to same size and format for comparison
-        stored_image = stored_image.convert('RGB').resize((256, 256))
-        captured_image = captured_image.convert('RGB').resize((256, 256))
-        
-        # Convert to numpy arrays for easier comparison
-        stored_array = np.array(stored_image)
-        captured_array = np.array(captured_image)
-        
-        # Calculate the absolute difference between images
-        diff = np.abs(stored_array - captured_array)
-        
-        # Count pixels that are similar (within a threshold)
-        threshold = 50  # Allow some variation in color
-        similar_pixels = np.sum(diff < threshold)
+        with timed('decode'):
+            captured_array = normalize_image(Image.open(BytesIO(captured_bytes)))
         
-        # Calculate similarity percentage
-        total_pixels = stored_array.size
-        similarity = (similar_pixels / total_pixels) * 100
+        with timed('similarity'):
+            similarity = similarity_score(stored_array, captured_array)
         
         # Return True if similarity is at least 10%
-        return similarity >= 10
+        return similarity >= MATCH_THRESHOLD
     except Exception as e:
         print(f"Image comparison error: {e}")
         return False
 
+def similarity_score(stored_array, captured_array):
+    # Score against every reference at once: (K, H, W, C) vs (H, W, C)
+    stored_stack = stored_array.reshape((-1,) + captured_array.shape)
+    
+    # Calculate the absolute difference between images
+    diff = np.abs(stored_stack - captured_array)
+    
+    # Count pixels that are similar (within a threshold)
+    threshold = 50  # Allow some variation in color
+    similar_pixels = np.count_nonzero(diff < threshold, axis=(1, 2, 3))
+    
+    # Calculate similarity percentage for the best reference
+    total_pixels = captured_array.size
+    return (similar_pixels.max() / total_pixels) * 100
+
+def warmup():
+    # Pay first-use costs before the first login rather than during it: the
+    # capture decoders (Pillow registers only its common plugins for this,
+    # not all of them as Image.init() would), one synthetic frame through the
+    # quality gate, decode and similarity, an encode in the enrollment format
+    # and the compiled page templates
+    height, width = TEMPLATE_SHAPE[:2]
+    frame = Image.new('RGB', (width, height), (128, 128, 128))
+    buffer = BytesIO()
+    frame.save(buffer, 'JPEG')
+    captured = buffer.getvalue()
+    check_frame(captured, app.config['QUALITY_GATE'])
+    template = normalize_image(Image.open(BytesIO(captured)))
+    similarity_score(template, template)
+    enrollment.encode(frame, enrollment.resolve_spec(app.config['ENROLLMENT_IMAGE']))
+    for name in ('signup.html', 'login.html', 'dashboard.html'):
+        app.jinja_env.get_template(name)
+
+def preload():
+    # Load everything workers only read, so a forking launcher can share it
+    # copy-on-write instead of every worker building its own copy
+    warmup()
+    users.load_all()
+    template_store.preload()
+
+def shutdown():
+    # Called by serve.py workers before os._exit(), which skips atexit
+    audit_log.close()
+
 @app.route('/')
 def index():
     return redirect(url_for('signup'))
 
 @app.route('/signup', methods=['GET', 'POST'])
+@admission.guard
 def signup():
     if request.method == 'POST':
-        username = request.form.get('username')
-        password = request.form.get('password')
-        confirm_password = request.form.get('confirm_password')
-        email = request.form.get('email')
-        image_data = request.form.get('image')
+        with timed('form'):
+            username = request.form.get('username')
+            password = request.form.get('password')
+            confirm_password = request.form.get('confirm_password')
+            email = request.form.get('email')
+            image_data = request.form.get('image')
+            # Further reference photos, if the client captured several;
+            # anything beyond the gallery size would be dropped anyway
+            extra_images = request.form.getlist('image')[1:app.config['GALLERY_SIZE']]
         
         # Validation
         if not username or not password or not confirm_password or not email or not image_data:
-            return jsonify({"success": False, "message": "All fields are required"})
+            return auth_response("signup", username, False, "All fields are required")
         
         if password != confirm_password:
-            return jsonify({"success": False, "message": "Passwords do not match"})
+            return auth_response("signup", username, False, "Passwords do not match")
         
         if not validate_email(email):
-            return jsonify({"success": False, "message": "Invalid email format"})
-        
-        if username in users:
-            return jsonify({"success": False, "message": "Username already exists"})
-        
-        # Save user data
-        image_path = save_image(image_data, username)
-        users[username] = {
-            'password': generate_password_hash(password),
-            'email': email,
-            'image_path': image_path
-        }
+            return auth_response("signup", username, False, "Invalid email format")
+        
+        # Claim the username before any slow work so two concurrent
+        # signups cannot both pass the check and overwrite each other's face
+        if not users.reserve(username):
+            return auth_response("signup", username, False, "Username already exists")
+        
+        try:
+            captures = []
+            for capture in [image_data] + extra_images:
+                image_bytes, problem = check_capture(capture)
+                if problem:
+                    message, extra = problem
+                    return auth_response("signup", username, False, message, **extra)
+                captures.append(image_bytes)
+            
+            # Save user data; the whole gallery is stored in one write
+            with timed('decode'):
+                references = [normalize_image(Image.open(BytesIO(image_bytes))) for image_bytes in captures[1:]]
+            image_path = save_image(image_data, username, captures[0], references)
+            with timed('hash'):
+                password_hash = generate_password_hash(password)
+            users.commit(username, {
+                'password': password_hash,
+                'email': email,
+                'image_path': image_path
+            })
+        finally:
+            # No-op once committed; frees the name if signup failed
+            users.release(username)
         
         session['username'] = username
-        return jsonify({"success": True, "message": "Signup successful"})
+        return auth_response("signup", username, True, "Signup successful")
     
-    return render_template('signup.html')
+    return render_template('signup.html', gallery_size=app.config['GALLERY_SIZE'])
 
 @app.route('/login', methods=['GET', 'POST'])
+@admission.guard
 def login():
     if request.method == 'POST':
-        username = request.form.get('username')
-        password = request.form.get('password')
-        image_data = request.form.get('image')
-        
-        # Validation
-        if not username or not password or not image_data:
-            return jsonify({"success": False, "message": "All fields are required"})
+        with timed('form'):
+            username = request.form.get('username')
+            password = request.form.get('password')
+            image_data = request.form.get('image')
         
-        if username not in users:
-            return jsonify({"success": False, "message": "Username not found"})
+        # Validation (the photo may be omitted on a trusted device)
+        if not username or not password:
+            return auth_response("login", username, False, "All fields are required")
         
-        user = users[username]
+        user = users.get(username)
+        if user is None:
+            return auth_response("login", username, False, "Username not found")
         
         # Check password
-        if not check_password_hash(user['password'], password):
-            return jsonify({"success": False, "message": "Incorrect password"})
+        with timed('hash'):
+            password_ok = check_password_hash(user['password'], password)
+        if not password_ok:
+            return auth_response("login", username, False, "Incorrect password")
+        
+        # A recent face match on this device stands in for the image check
+        window = app.config['TRUSTED_DEVICE_WINDOW']
+        template_version = template_store.version(username)
+        device_token = request.cookies.get(trusted_devices.cookie_name(username))
+        if device_token and window > 0:
+            # forget_device in any worker bumps the epoch in the shared record
+            device_epoch = (users.reload(username) or user).get('device_epoch', 0)
+        else:
+            device_epoch = None
+        if trusted_devices.verify(device_token, username, template_version, device_epoch, window):
+            session['username'] = username
+            return auth_response("login", username, True, "Login successful", trusted_device=True)
+        
+        if not image_data:
+            # Streaming mode: the face is verified over /login/stream next
+            if request.form.get('stream') and stream_login_available:
+                session['stream_login'] = {
+                    'u': username,
+                    'exp': time.time() + app.config['STREAM_TIMEOUT'] * 2,
+                }
+                return jsonify({"success": False, "stream": True, "message": "Password accepted. Please look at the camera."})
+            return auth_response("login", username, False, "Please capture a photo", face_required=True)
+        
+        # A resubmitted frame gets its earlier verdict without any decoding
+        cache_key = (username, payload_digest(image_data), template_version)
+        matched = result_cache.get(cache_key)
+        if matched is None:
+            image_bytes, problem = check_capture(image_data)
+            if problem:
+                message, extra = problem
+                return auth_response("login", username, False, message, **extra)
+            
+            # Check image with 10% match threshold
+            matched = compare_images(user['image_path'], image_data, template_store.get(username), image_bytes)
+            result_cache.put(cache_key, matched)
         
-        # Check image with 10% match threshold
-        if not compare_images(user['image_path'], image_data):
-            return jsonify({"success": False, "message": "Face does not match. Please try again.", "retry": True})
+        if not matched:
+            return auth_response("login", username, False, "Face does not match. Please try again.", retry=True)
         
         session['username'] = username
-        return jsonify({"success": True, "message": "Login successful"})
+        return trust_device(auth_response("login", username, True, "Login successful"), username)
     
     return render_template('login.html')
 
+def trust_device(response, username):
+    # After a face match, let this device skip the face check for a while
+    window = app.config['TRUSTED_DEVICE_WINDOW']
+    if window > 0:
+        device_epoch = (users.reload(username) or {}).get('device_epoch', 0)
+        response.set_cookie(
+            trusted_devices.cookie_name(username),
+            trusted_devices.issue(username, template_store.version(username), device_epoch),
+            max_age=window,
+            httponly=True,
+            secure=request.is_secure,
+            samesite='Lax',
+        )
+    return response
+
+def frame_bytes(data):
+    # Streamed frames arrive as binary JPEG or as a data URL
+    if isinstance(data, str):
+        data = base64.b64decode(data.split(',')[1])
+    return data
+
+def decode_frame(image_bytes):
+    image = Image.open(BytesIO(image_bytes))
+    height, width = TEMPLATE_SHAPE[:2]
+    image.draft('RGB', (width, height))
+    return normalize_image(image)
+
+def login_stream(ws):
+    # Score streamed frames against the loaded reference until the running
+    # score is confident enough, instead of one request per captured still
+    pending = session.get('stream_login')
+    if not pending or pending['exp'] < time.time():
+        ws.send(json.dumps({"success": False, "message": "Please enter your password first"}))
+        return
+    username = pending['u']
+    user = users.get(username)
+    reference = template_store.get(username)
+    if reference is None and user is not None:
+        with open(user['image_path'], 'rb') as f:
+            reference = normalize_image(enrollment.decode(f.read(), user['image_path']))
+    if reference is None:
+        ws.send(json.dumps({"success": False, "message": "Username not found"}))
+        return
+    
+    smoothing = app.config['STREAM_SMOOTHING']
+    deadline = time.time() + app.config['STREAM_TIMEOUT']
+    score = None
+    frames = 0
+    while frames < app.config['STREAM_MAX_FRAMES']:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        data = ws.receive(timeout=remaining)
+        if data is None:
+            break
+        
+        try:
+            admission.acquire()
+        except Overloaded:
+            ws.send(json.dumps({"busy": True, "retry_after": admission.retry_after}))
+            continue
+        try:
+            # Same quality gate as a captured still; cheap at 320x240
+            image_bytes = frame_bytes(data)
+            with timed('quality'):
+                problem = check_frame(image_bytes, app.config['QUALITY_GATE'])
+            if not problem:
+                similarity = similarity_score(reference, decode_frame(image_bytes))
+        except Exception:
+            ws.send(json.dumps({"frame": frames, "message": "Could not read frame"}))
+            continue
+        finally:
+            admission.release()
+        if problem:
+            reason, message = problem
+            ws.send(json.dumps({"frame": frames, "reason": reason, "message": message}))
+            continue
+        
+        frames += 1
+        score = similarity if score is None else smoothing * similarity + (1 - smoothing) * score
+        if frames >= app.config['STREAM_MIN_FRAMES'] and score >= MATCH_THRESHOLD:
+            ticket = stream_tickets.dumps({'u': username, 'id': os.urandom(9).hex()})
+            audit_log.record("login", username, True, "Login successful (stream)")
+            ws.send(json.dumps({"success": True, "message": "Login successful", "ticket": ticket}))
+            return
+        ws.send(json.dumps({"frame": frames, "score": round(score, 1)}))
+    
+    audit_log.record("login", username, False, "Face does not match. Please try again.")
+    ws.send(json.dumps({"success": False, "message": "Face does not match. Please try again.", "retry": True}))
+
+class _RouteCapture:
+    # Stands in for a blueprint so flask-sock hands back its wrapped view
+    def route(self, rule, **options):
+        def capture(view):
+            self.view = view
+            return view
+        return capture
+
+_stream_view = None
+
+def login_stream_route():
+    # flask-sock pulls in asyncio through simple-websocket, which would add
+    # ~30 ms to every cold start for a feature most logins never touch
+    global _stream_view
+    if _stream_view is None:
+        from flask_sock import Sock
+        capture = _RouteCapture()
+        Sock().route('/login/stream', bp=capture)(login_stream)
+        _stream_view = capture.view
+    return _stream_view()
+
+if stream_login_available:
+    app.add_url_rule('/login/stream', 'login_stream', login_stream_route, websocket=True)
+
+@app.route('/login/stream/complete')
+def login_stream_complete():
+    # Trade the one-time ticket from the stream for a session; it only
+    # works in the browser that passed the password step
+    pending = session.pop('stream_login', None)
+    try:
+        payload = stream_tickets.loads(request.args.get('ticket', ''), max_age=STREAM_TICKET_TTL)
+    except BadSignature:
+        payload = None
+    # The session is a client-side cookie and can be replayed, so single use
+    # is enforced by claiming the ticket id in the shared folder
+    if not payload or not pending or payload['u'] != pending['u'] or not used_stream_tickets.claim(payload['id']):
+        return redirect(url_for('login'))
+    
+    session['username'] = payload['u']
+    return trust_device(redirect(url_for('dashboard')), payload['u'])
+
+@app.route('/enroll', methods=['POST'])
+@admission.guard
+def enroll():
+    # Add another reference photo for the logged-in user
+    if 'username' not in session:
+        return jsonify({"success": False, "message": "Please log in first"}), 401
+    username = session['username']
+    if username not in users:
+        return jsonify({"success": False, "message": "Username not found"}), 404
+    
+    image_data = request.form.get('image')
+    if not image_data:
+        return jsonify({"success": False, "message": "Please capture a photo"})
+    
+    image_bytes, problem = check_capture(image_data)
+    if problem:
+        message, extra = problem
+        return jsonify({"success": False, "message": message, **extra})
+    
+    references = add_reference(username, image_bytes)
+    audit_log.record('enroll', username, True, 'Reference photo added')
+    return jsonify({"success": True, "message": "Reference photo added", "references": references})
+
 @app.route('/dashboard')
 def dashboard():
     if 'username' not in session:
         return redirect(url_for('login'))
-    return render_template('dashboard.html', username=session['username'])
+    username = session['username']
+    gallery = template_store.get(username)
+    return render_template(
+        'dashboard.html',
+        username=username,
+        references=0 if gallery is None else len(gallery),
+        gallery_size=app.config['GALLERY_SIZE'],
+    )
 
 @app.route('/logout')
 def logout():
-    session.pop('username', None)
-    return redirect(url_for('login'))
+    username = session.pop('username', None)
+    response = redirect(url_for('login'))
+    
+    # /logout?forget_device=1 also stops trusting this device for the user.
+    # Bumping the device epoch in the shared record revokes the user's tokens
+    # in every worker; the local revocation set just answers this one faster.
+    if username and request.args.get('forget_device'):
+        cookie_name = trusted_devices.cookie_name(username)
+        token = request.cookies.get(cookie_name)
+        if token:
+            trusted_devices.revoke(token, app.config['TRUSTED_DEVICE_WINDOW'])
+        user = users.reload(username)
+        if user is not None:
+            users.update(username, dict(user, device_epoch=user.get('device_epoch', 0) + 1))
+        response.delete_cookie(cookie_name)
+    return response
 
-if __name__ == '__main__':
+def write_templates():
     # Create templates directory if it doesn't exist
     os.makedirs('templates', exist_ok=True)
     
@@ -375,6 +776,7 @@ if __name__ == '__main__':
                     <button type="button" id="capture-photo" class="camera-btn">Capture Photo</button>
                 </div>
                 <img id="photo-preview">
+                <p id="photo-count">Capture up to {{ gallery_size }} photos, e.g. in different lighting.</p>
             </div>
             
             <button type="submit">Sign Up</button>
@@ -394,8 +796,11 @@ if __name__ == '__main__':
             const form = document.getElementById('signup-form');
             const notification = document.getElementById('notification');
             
+            const photoCount = document.getElementById('photo-count');
+            const maxPhotos = {{ gallery_size }};
+            
             let stream = null;
-            let capturedImage = null;
+            let capturedImages = [];
             
             startButton.addEventListener('click', async function() {
                 try {
@@ -420,29 +825,37 @@ if __name__ == '__main__':
             captureButton.addEventListener('click', function() {
                 context.drawImage(video, 0, 0, canvas.width, canvas.height);
                 const imageData = canvas.toDataURL('image/jpeg', 0.9);
-                capturedImage = imageData;
+                capturedImages.push(imageData);
                 
                 photoPreview.src = imageData;
                 photoPreview.style.display = 'block';
+                photoCount.textContent = `${capturedImages.length} of up to ${maxPhotos} photos captured`;
                 
-                // Stop the camera stream
+                // The camera keeps running for further reference photos
+                // until the gallery is full
+                if (capturedImages.length >= maxPhotos) {
+                    stopCamera();
+                }
+            });
+            
+            function stopCamera() {
                 if (stream) {
                     stream.getTracks().forEach(track => track.stop());
                 }
                 video.style.display = 'none';
                 captureButton.disabled = true;
-            });
+            }
             
             form.addEventListener('submit', function(e) {
                 e.preventDefault();
                 
-                if (!capturedImage) {
+                if (!capturedImages.length) {
                     showNotification('Please capture a photo', 'error');
                     return;
                 }
                 
                 const formData = new FormData(form);
-                formData.append('image', capturedImage);
+                capturedImages.forEach(image => formData.append('image', image));
                 
                 fetch('/signup', {
                     method: 'POST',
@@ -455,6 +868,15 @@ if __name__ == '__main__':
                         setTimeout(() => window.location.href = '/dashboard', 1500);
                     } else {
                         showNotification(data.message, 'error');
+                        
+                        // If a photo was unusable, let the user capture again
+                        if (data.retry) {
+                            stopCamera();
+                            capturedImages = [];
+                            photoPreview.style.display = 'none';
+                            photoCount.textContent = `Capture up to ${maxPhotos} photos, e.g. in different lighting.`;
+                            startButton.disabled = false;
+                        }
                     }
                 })
                 .catch(error => {
@@ -747,25 +1169,60 @@ if __name__ == '__main__':
             form.addEventListener('submit', function(e) {
                 e.preventDefault();
                 
-                if (!capturedImage) {
-                    showNotification('Please capture a photo', 'error');
-                    return;
-                }
-                
+                // Without a photo the server still accepts a trusted device
                 const formData = new FormData(form);
-                formData.append('image', capturedImage);
+                if (capturedImage) {
+                    formData.append('image', capturedImage);
+                } else if ('WebSocket' in window) {
+                    // Otherwise verify the face from a live stream after the password step
+                    formData.append('stream', '1');
+                }
                 
+                submitLogin(formData, 0);
+            });
+            
+            // Back off when the server sheds load (503 + Retry-After)
+            const MAX_BUSY_RETRIES = 5;
+            
+            function busyDelay(response, attempt) {
+                const retryAfter = parseFloat(response.headers.get('Retry-After')) || 1;
+                const backoff = Math.min(30, retryAfter * Math.pow(2, attempt));
+                return (backoff + Math.random() * retryAfter) * 1000;
+            }
+            
+            function submitLogin(formData, attempt) {
                 fetch('/login', {
                     method: 'POST',
                     body: formData
                 })
-                .then(response => response.json())
+                .then(response => {
+                    if (response.status === 503 && attempt < MAX_BUSY_RETRIES) {
+                        const delay = busyDelay(response, attempt);
+                        showNotification(`Server is busy. Retrying in ${Math.ceil(delay / 1000)}s...`, 'error');
+                        setTimeout(() => submitLogin(formData, attempt + 1), delay);
+                        return null;
+                    }
+                    return response.json();
+                })
                 .then(data => {
+                    if (!data) {
+                        return;
+                    }
+                    
                     if (data.success) {
                         showNotification(data.message, 'success');
                         setTimeout(() => window.location.href = '/dashboard', 1500);
                     } else {
-                        showNotification(data.message, 'error');
+                        showNotification(data.message, data.stream ? 'success' : 'error');
+                        
+                        if (data.stream) {
+                            streamFace();
+                        }
+                        
+                        // Not a trusted device: a photo is needed after all
+                        if (data.face_required && !stream) {
+                            startCamera();
+                        }
                         
                         // If face doesn't match, restart camera for retry
                         if (data.retry) {
@@ -779,7 +1236,72 @@ if __name__ == '__main__':
                 .catch(error => {
                     showNotification('An error occurred. Please try again.', 'error');
                 });
-            });
+            }
+            
+            // Send small frames one at a time until the server is confident of a match
+            const STREAM_INTERVAL = 200;
+            const frameCanvas = document.createElement('canvas');
+            frameCanvas.width = 320;
+            frameCanvas.height = 240;
+            
+            async function streamFace() {
+                if (!stream) {
+                    await startCamera();
+                }
+                if (!stream) {
+                    return;
+                }
+                
+                const scheme = window.location.protocol === 'https:' ? 'wss' : 'ws';
+                const socket = new WebSocket(`${scheme}://${window.location.host}/login/stream`);
+                
+                function sendFrame() {
+                    if (socket.readyState !== WebSocket.OPEN) {
+                        return;
+                    }
+                    frameCanvas.getContext('2d').drawImage(video, 0, 0, frameCanvas.width, frameCanvas.height);
+                    frameCanvas.toBlob(blob => {
+                        if (blob && socket.readyState === WebSocket.OPEN) {
+                            socket.send(blob);
+                        }
+                    }, 'image/jpeg', 0.8);
+                }
+                
+                socket.onopen = function() {
+                    if (video.readyState >= 2) {
+                        sendFrame();
+                    } else {
+                        video.addEventListener('loadeddata', sendFrame, { once: true });
+                    }
+                };
+                
+                socket.onmessage = function(event) {
+                    const data = JSON.parse(event.data);
+                    
+                    // Progress or busy: the next frame goes out once this one is scored
+                    if (data.success === undefined) {
+                        if (data.reason) {
+                            showNotification(data.message, 'error');
+                        }
+                        const delay = data.busy ? data.retry_after * 1000 : STREAM_INTERVAL;
+                        setTimeout(sendFrame, delay);
+                        return;
+                    }
+                    
+                    socket.close();
+                    showNotification(data.message, data.success ? 'success' : 'error');
+                    if (data.success) {
+                        if (stream) {
+                            stream.getTracks().forEach(track => track.stop());
+                        }
+                        window.location.href = '/login/stream/complete?ticket=' + encodeURIComponent(data.ticket);
+                    }
+                };
+                
+                socket.onerror = function() {
+                    showNotification('Live verification failed. Please capture a photo.', 'error');
+                };
+            }
             
             function showNotification(message, type) {
                 notification.textContent = message;
@@ -956,6 +1478,55 @@ if __name__ == '__main__':
             box-shadow: 0 5px 15px rgba(244, 67, 54, 0.3);
         }
         
+        .references {
+            text-align: center;
+            margin-bottom: 30px;
+        }
+        
+        .references video {
+            display: none;
+            max-width: 100%;
+            margin: 15px auto;
+            border-radius: 12px;
+        }
+        
+        .references canvas {
+            display: none;
+        }
+        
+        .camera-btn {
+            background: linear-gradient(45deg, #2196F3, #0b7dda);
+            color: white;
+            margin: 8px;
+            padding: 12px 20px;
+            border: none;
+            cursor: pointer;
+            border-radius: 8px;
+            font-size: 16px;
+            font-weight: 600;
+        }
+        
+        .camera-btn:disabled {
+            opacity: 0.5;
+            cursor: default;
+        }
+        
+        .notification {
+            padding: 15px;
+            margin: 15px 0;
+            border-radius: 8px;
+        }
+        
+        .error {
+            background: #ffdddd;
+            color: #f44336;
+        }
+        
+        .success {
+            background: #ddffdd;
+            color: #4CAF50;
+        }
+        
         footer {
             margin-top: 30px;
             text-align: center;
@@ -1006,14 +1577,84 @@ if __name__ == '__main__':
             </div>
         </div>
         
+        <div class="dashboard-card references">
+            <div class="card-icon">📷</div>
+            <div class="card-title">Reference Photos</div>
+            <div class="card-description" id="reference-count">{{ references }} of {{ gallery_size }} stored. Add photos in other lighting to make face login more reliable; the oldest is replaced once the gallery is full.</div>
+            <div id="notification"></div>
+            <video id="video" width="640" height="480" autoplay></video>
+            <canvas id="canvas" width="640" height="480"></canvas>
+            <button type="button" id="start-camera" class="camera-btn">Start Camera</button>
+            <button type="button" id="add-photo" class="camera-btn" disabled>Add Photo</button>
+        </div>
+        
         <a href="/logout" class="logout-btn">Logout</a>
         
         <footer>
             © 2023 SmartLogin. All rights reserved.
         </footer>
     </div>
+
+    <script>
+        document.addEventListener('DOMContentLoaded', function() {
+            const video = document.getElementById('video');
+            const canvas = document.getElementById('canvas');
+            const context = canvas.getContext('2d');
+            const startButton = document.getElementById('start-camera');
+            const addButton = document.getElementById('add-photo');
+            const referenceCount = document.getElementById('reference-count');
+            const notification = document.getElementById('notification');
+            
+            startButton.addEventListener('click', async function() {
+                try {
+                    video.srcObject = await navigator.mediaDevices.getUserMedia({
+                        video: { width: { ideal: 640 }, height: { ideal: 480 }, facingMode: 'user' }
+                    });
+                    video.style.display = 'block';
+                    startButton.disabled = true;
+                    addButton.disabled = false;
+                } catch (err) {
+                    showNotification('Camera access denied or not available', 'error');
+                }
+            });
+            
+            addButton.addEventListener('click', function() {
+                context.drawImage(video, 0, 0, canvas.width, canvas.height);
+                const formData = new FormData();
+                formData.append('image', canvas.toDataURL('image/jpeg', 0.9));
+                addButton.disabled = true;
+                
+                fetch('/enroll', { method: 'POST', body: formData })
+                .then(response => response.json())
+                .then(data => {
+                    showNotification(data.message, data.success ? 'success' : 'error');
+                    if (data.success) {
+                        referenceCount.textContent = `${data.references} of {{ gallery_size }} stored.`;
+                    }
+                })
+                .catch(error => {
+                    showNotification('An error occurred. Please try again.', 'error');
+                })
+                .finally(() => {
+                    addButton.disabled = false;
+                });
+            });
+            
+            function showNotification(message, type) {
+                notification.textContent = message;
+                notification.className = `notification ${type}`;
+                notification.style.display = 'block';
+                
+                setTimeout(() => {
+                    notification.style.display = 'none';
+                }, 5000);
+            }
+        });
+    </script>
 </body>
 </html>
         ''')
-    
+
+if __name__ == '__main__':
+    write_templates()
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,69 @@
+import os
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, features
+
+# Encoding of the enrollment image stored in uploads/.
+#
+# The matcher only ever looks at a 256x256 RGB copy, so storing the full
+# resolution capture mostly costs disk and decode time. 'size' resizes to a
+# square before encoding; 'NPY' stores the raw uint8 array so loading it
+# needs no image decode at all.
+
+FORMATS = {
+    'JPEG': '.jpg',
+    'PNG': '.png',
+    'WEBP': '.webp',
+    'NPY': '.npy',
+}
+
+DEFAULT_SPEC = {
+    'format': 'JPEG',
+    'size': None,             # e.g. 256 or 128; None keeps the captured size
+    'quality': 95,            # JPEG/WEBP only
+    'keep_original': False,   # also keep the captured bytes in cold_folder
+    'cold_folder': 'uploads_cold',
+}
+
+
+def resolve_spec(spec=None):
+    spec = dict(DEFAULT_SPEC, **(spec or {}))
+    spec['format'] = spec['format'].upper()
+    if spec['format'] not in FORMATS:
+        raise ValueError(f"Unsupported enrollment format {spec['format']!r}; choose from {', '.join(FORMATS)}")
+    if spec['format'] == 'WEBP' and not features.check('webp'):
+        raise ValueError('Pillow was built without WebP support')
+    return spec
+
+
+def encode(image, spec):
+    """Encode a PIL image per spec and return (bytes, file extension)."""
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    if spec['size']:
+        image = image.resize((spec['size'], spec['size']))
+
+    buffer = BytesIO()
+    if spec['format'] == 'NPY':
+        np.save(buffer, np.asarray(image))
+    elif spec['format'] == 'PNG':
+        image.save(buffer, 'PNG')
+    else:
+        image.save(buffer, spec['format'], quality=spec['quality'])
+    return buffer.getvalue(), FORMATS[spec['format']]
+
+
+def decode(data, path=''):
+    """Return a PIL image from stored enrollment bytes."""
+    if path.endswith('.npy'):
+        return Image.fromarray(np.load(BytesIO(data)))
+    return Image.open(BytesIO(data))
+
+
+def keep_original(data, filename, spec):
+    os.makedirs(spec['cold_folder'], exist_ok=True)
+    path = os.path.join(spec['cold_folder'], filename)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
@@ -0,0 +1,402 @@
+import argparse
+import base64
+import functools
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from quality import check_frame
+
+# Closed-loop load generator for the Smart-Login app.
+#
+# Every worker thread sends one request, waits for the reply and immediately
+# sends the next one, so the offered load is bounded by --concurrency.
+# Synthetic users get a procedurally generated "face" which is enrolled
+# through /signup before the timed phase starts.
+
+SCENARIOS = ('correct', 'wrong_password', 'face_mismatch')
+
+MATCH_THRESHOLD = 10  # dev.MATCH_THRESHOLD, percent of similar pixels
+
+
+def generate_face(seed, size=(320, 240), capture=0):
+    # `seed` fixes the face; `capture` numbers repeated shots of it
+    image = draw_face(face_seed(seed, size), size)
+    add_noise(image, seed, capture)
+    return image
+
+
+@functools.lru_cache(maxsize=None)
+def face_seed(seed, size):
+    # Re-seed faces whose enrolled frame the login quality gate rejects,
+    # e.g. as low_contrast when skin and background colours are too close
+    candidates = itertools.chain([seed], (f'{seed}#{attempt}' for attempt in itertools.count(1)))
+    for candidate in candidates:
+        image = draw_face(candidate, size)
+        add_noise(image, seed, 0)
+        if check_frame(to_jpeg(image)) is None:
+            return candidate
+
+
+def draw_face(seed, size):
+    rng = random.Random(seed)
+    skin = tuple(rng.randint(120, 240) for _ in range(3))
+    background = tuple(rng.randint(0, 255) for _ in range(3))
+
+    image = Image.new('RGB', size, background)
+    draw = ImageDraw.Draw(image)
+    width, height = size
+
+    # Head
+    cx, cy = width // 2 + rng.randint(-20, 20), height // 2 + rng.randint(-10, 10)
+    rx, ry = rng.randint(60, 80), rng.randint(80, 100)
+    draw.ellipse((cx - rx, cy - ry, cx + rx, cy + ry), fill=skin)
+
+    # Eyes and mouth
+    eye_dx, eye_y = rng.randint(20, 35), cy - rng.randint(15, 35)
+    for ex in (cx - eye_dx, cx + eye_dx):
+        draw.ellipse((ex - 8, eye_y - 5, ex + 8, eye_y + 5), fill=(30, 30, 30))
+    mouth_y = cy + rng.randint(30, 50)
+    draw.arc((cx - 30, mouth_y - 15, cx + 30, mouth_y + 15), 20, 160, fill=(120, 20, 20), width=4)
+    return image
+
+
+def add_noise(image, seed, capture):
+    # Sensor noise, seeded per capture so each shot of a face differs
+    noise = random.Random(f'{seed}/{capture}')
+    width, height = image.size
+    pixels = image.load()
+    for _ in range(width * height // 50):
+        x, y = noise.randrange(width), noise.randrange(height)
+        pixels[x, y] = tuple(noise.randint(0, 255) for _ in range(3))
+
+
+def to_jpeg(image):
+    buffer = BytesIO()
+    image.save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def to_data_url(image):
+    return 'data:image/jpeg;base64,' + base64.b64encode(to_jpeg(image)).decode('ascii')
+
+
+def match_score(reference, probe):
+    # dev.similarity_score of the two JPEGs after dev.normalize_image
+    reference, probe = (
+        np.array(Image.open(BytesIO(jpeg)).convert('RGB').resize((256, 256)))
+        for jpeg in (reference, probe)
+    )
+    return np.count_nonzero(np.abs(reference - probe) < 50) / reference.size * 100
+
+
+def mismatch_face(seed, capture=0):
+    # Colour-inverted, mirrored face of another seed
+    image = generate_face(seed, capture=capture).transpose(Image.FLIP_LEFT_RIGHT)
+    return Image.eval(image, lambda value: 255 - value)
+
+
+def mismatch_seed(seed):
+    # Re-seed until the matcher rejects the probe against the face enrolled
+    # for `seed`, with enough margin that capture noise cannot lift it over,
+    # and the quality gate lets it through to the matcher
+    reference = to_jpeg(generate_face(seed))
+    for candidate in itertools.count(seed + 1000003, 1000003):
+        probe = to_jpeg(mismatch_face(candidate))
+        if match_score(reference, probe) < MATCH_THRESHOLD / 2 and check_frame(probe) is None:
+            return candidate
+
+
+def post(url, fields, timeout):
+    data = urllib.parse.urlencode(fields).encode('ascii')
+    req = urllib.request.Request(url, data=data, method='POST')
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        retry_after = e.headers.get('Retry-After')
+        return e.code, {'retry_after': float(retry_after)} if retry_after else None
+
+
+def process_tree(pid):
+    # pid plus all descendants, e.g. preforked workers or the reloader child
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        parents.setdefault(ppid, []).append(int(entry))
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(parents.get(current, []))
+    return tree
+
+
+def read_field_kb(path, field):
+    try:
+        with open(path) as f:
+            for line in f:
+                if line.startswith(field):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def read_memory_kb(pid):
+    # RSS double counts pages shared between forked workers; PSS splits them
+    rss_total, pss_total = 0, 0
+    for member in process_tree(pid):
+        rss = read_field_kb(f'/proc/{member}/status', 'VmRSS:')
+        if rss is None:
+            continue
+        pss = read_field_kb(f'/proc/{member}/smaps_rollup', 'Pss:')
+        rss_total += rss
+        pss_total += pss if pss is not None else rss
+    if not rss_total:
+        return None
+    return rss_total, pss_total
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def start_server(port, launcher, workers):
+    # The server keeps its data in the current directory, so the app is found
+    # through PYTHONPATH rather than by changing into the repository
+    root = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')])))
+    if launcher == 'serve':
+        command = [sys.executable, os.path.join(root, 'serve.py'), '--port', str(port), '--workers', str(workers)]
+    else:
+        # Same as "python dev.py", on the requested port
+        code = f'import dev; dev.app.run(host="127.0.0.1", port={port}, debug=True)'
+        command = [sys.executable, '-c', code]
+    process = subprocess.Popen(
+        command,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            # An empty login is rejected by validation without touching templates
+            post(f'http://127.0.0.1:{port}/login', {}, timeout=1)
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError('Server did not start')
+
+
+def enroll(base_url, count, prefix, timeout):
+    users = []
+    for i in range(count):
+        username = f'{prefix}{i}'
+        password = f'pw-{i}-{random.random():.6f}'
+        status, body = post(base_url + '/signup', {
+            'username': username,
+            'password': password,
+            'confirm_password': password,
+            'email': f'{username}@loadtest.local',
+            'image': to_data_url(generate_face(i)),
+        }, timeout)
+        if status != 200 or not body or not body.get('success'):
+            # One bad enrollment should not abort the whole run
+            print(f'Enrollment failed for {username}: {status} {body}')
+            continue
+        users.append((i, username, password))
+    return users
+
+
+def capture_pool(seed, size):
+    # `size` distinct captures of the user's face and of its mismatch probe,
+    # skipping the rare shot whose noise the quality gate rejects. Drawing a
+    # face costs milliseconds of Python, so this runs before the timed phase.
+    other = mismatch_seed(seed)
+    pool = {'face': [], 'mismatch': []}
+    for capture in itertools.count(1):  # 0 is the enrolled frame
+        for kind, image in (('face', generate_face(seed, capture=capture)),
+                            ('mismatch', mismatch_face(other, capture))):
+            jpeg = to_jpeg(image)
+            if len(pool[kind]) < size and check_frame(jpeg) is None:
+                pool[kind].append(jpeg)
+        if all(len(frames) == size for frames in pool.values()):
+            return pool
+
+
+def stamp(jpeg, request_id):
+    # Insert a comment segment after SOI: the pixels stay the same but every
+    # request's payload digest differs, so the server's result cache never
+    # turns a login into a hit and the whole pipeline is measured
+    comment = str(request_id).encode('ascii')
+    return jpeg[:2] + b'\xff\xfe' + (len(comment) + 2).to_bytes(2, 'big') + comment + jpeg[2:]
+
+
+def build_request(user, scenario, pools, request_id):
+    seed, username, password = user
+    frames = pools[seed]['mismatch' if scenario == 'face_mismatch' else 'face']
+    jpeg = stamp(frames[request_id % len(frames)], request_id)
+    if scenario == 'wrong_password':
+        password += 'x'
+    image = 'data:image/jpeg;base64,' + base64.b64encode(jpeg).decode('ascii')
+    return {'username': username, 'password': password, 'image': image}
+
+
+def expected_outcome(scenario, body):
+    if body is None:
+        return False
+    if scenario == 'correct':
+        return body.get('success') is True
+    if scenario == 'wrong_password':
+        return body.get('message') == 'Incorrect password'
+    return body.get('success') is False and body.get('retry') is True
+
+
+def run(args):
+    server = None
+    base_url = args.url.rstrip('/') if args.url else None
+    if base_url is None:
+        server = start_server(args.port, args.launcher, args.workers)
+        base_url = f'http://127.0.0.1:{args.port}'
+    server_pid = args.server_pid or (server.pid if server else None)
+
+    try:
+        prefix = f'lt{int(time.time())}_'
+        print(f'Enrolling {args.users} synthetic users against {base_url} ...')
+        users = enroll(base_url, args.users, prefix, args.timeout)
+        if not users:
+            raise RuntimeError('No synthetic user could be enrolled')
+        print(f'Enrolled {len(users)} of {args.users} users')
+        pools = {seed: capture_pool(seed, args.captures) for seed, _, _ in users}
+        request_ids = itertools.count()
+
+        weights = [args.correct, args.wrong_password, args.face_mismatch]
+        stop_at = time.time() + args.duration
+        lock = threading.Lock()
+        samples = []  # (scenario, latency_ms, ok, transport_error, shed)
+
+        def worker(worker_id):
+            rng = random.Random(worker_id)
+            while time.time() < stop_at:
+                user = rng.choice(users)
+                scenario = rng.choices(SCENARIOS, weights)[0]
+                fields = build_request(user, scenario, pools, next(request_ids))
+                start = time.perf_counter()
+                try:
+                    status, body = post(base_url + '/login', fields, args.timeout)
+                except OSError:
+                    status, body = None, None
+                latency_ms = (time.perf_counter() - start) * 1000
+                # 503 means admission control shed the request on purpose
+                shed = status == 503
+                transport_error = status not in (200, 503)
+                ok = not transport_error and not shed and expected_outcome(scenario, body)
+                with lock:
+                    samples.append((scenario, latency_ms, ok, transport_error, shed))
+                if shed:
+                    # Back off like the login page does
+                    time.sleep(body['retry_after'] if body else 1.0)
+
+        rss_series = []
+
+        def sample_rss():
+            started = time.time()
+            while time.time() < stop_at:
+                memory = read_memory_kb(server_pid) if server_pid else None
+                if memory is not None:
+                    rss_series.append((time.time() - started,) + memory)
+                time.sleep(args.rss_interval)
+
+        print(f'Driving load: concurrency={args.concurrency} duration={args.duration}s')
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.concurrency)]
+        threads.append(threading.Thread(target=sample_rss))
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+
+        report(samples, rss_series, elapsed)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+def report(samples, rss_series, elapsed):
+    total = len(samples)
+    print(f'\nRequests: {total}  Throughput: {total / elapsed:.1f} req/s')
+
+    for scenario in ('all',) + SCENARIOS:
+        subset = [s for s in samples if scenario == 'all' or s[0] == scenario]
+        if not subset:
+            continue
+        # Latency and outcome of the requests the server actually admitted
+        admitted = [s for s in subset if not s[4]]
+        shed = len(subset) - len(admitted)
+        latencies = sorted(s[1] for s in admitted) or [0.0]
+        unexpected = sum(1 for s in admitted if not s[2])
+        transport = sum(1 for s in admitted if s[3])
+        print(
+            f'  {scenario:<15} n={len(subset):<6} '
+            f'p50={percentile(latencies, 50):7.1f}ms '
+            f'p90={percentile(latencies, 90):7.1f}ms '
+            f'p99={percentile(latencies, 99):7.1f}ms '
+            f'max={latencies[-1]:7.1f}ms '
+            f'unexpected={unexpected / max(1, len(admitted)):6.2%} (transport errors {transport}) '
+            f'shed={shed}'
+        )
+
+    if rss_series:
+        print('\nServer memory over time (all server processes):')
+        for offset, rss, pss in rss_series:
+            print(f'  t={offset:6.1f}s  rss={rss / 1024:7.1f} MiB  pss={pss / 1024:7.1f} MiB')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Closed-loop load test for Smart-Login')
+    parser.add_argument('--url', help='Target server; a local server is started when omitted')
+    parser.add_argument('--port', type=int, default=5055, help='Port for the locally started server')
+    parser.add_argument('--launcher', choices=['dev', 'serve'], default='dev',
+                        help='Start the local server with app.run(debug=True) or serve.py')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Workers for --launcher serve')
+    parser.add_argument('--server-pid', type=int, help='PID to sample RSS from when using --url')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--captures', type=int, default=8, help='Distinct captures generated per user')
+    parser.add_argument('--duration', type=float, default=30.0, help='Seconds of timed load')
+    parser.add_argument('--correct', type=float, default=0.7, help='Weight of correct logins')
+    parser.add_argument('--wrong-password', type=float, default=0.2, help='Weight of wrong passwords')
+    parser.add_argument('--face-mismatch', type=float, default=0.1, help='Weight of face mismatches')
+    parser.add_argument('--timeout', type=float, default=30.0, help='Per-request timeout in seconds')
+    parser.add_argument('--rss-interval', type=float, default=1.0, help='Seconds between RSS samples')
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
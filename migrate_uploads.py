@@ -0,0 +1,146 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import enrollment
+from template_store import TEMPLATE_SHAPE
+from user_registry import UserRegistry
+
+# Re-encodes existing enrollment images in uploads/ to a new enrollment
+# format, in parallel, and reports the disk and login decode-time savings.
+# Records in users/ are pointed at the new files. Run it while the server
+# is stopped: running workers keep user records cached in memory.
+
+DECODE_REPEATS = 5
+
+
+def decode_ms(data, path):
+    # Best-of-N time to turn stored bytes into the 256x256 comparison array
+    height, width = TEMPLATE_SHAPE[:2]
+    best = None
+    for _ in range(DECODE_REPEATS):
+        start = time.perf_counter()
+        np.array(enrollment.decode(data, path).convert('RGB').resize((width, height)))
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def migrate_file(path, spec, dry_run):
+    with open(path, 'rb') as f:
+        original = f.read()
+    before_ms = decode_ms(original, path)
+
+    encoded, extension = enrollment.encode(enrollment.decode(original, path), spec)
+    stem = os.path.splitext(path)[0]
+    new_path = stem + extension
+    after_ms = decode_ms(encoded, new_path)
+
+    if not dry_run:
+        if spec['keep_original']:
+            enrollment.keep_original(original, os.path.basename(path), spec)
+        tmp_path = new_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(encoded)
+        os.replace(tmp_path, new_path)
+        if new_path != path:
+            os.remove(path)
+
+    return {
+        'path': path,
+        'new_path': new_path,
+        'bytes_before': len(original),
+        'bytes_after': len(encoded),
+        'decode_ms_before': before_ms,
+        'decode_ms_after': after_ms,
+    }
+
+
+def find_uploads(folder):
+    extensions = set(enrollment.FORMATS.values())
+    return sorted(
+        os.path.join(folder, name)
+        for name in os.listdir(folder)
+        if os.path.splitext(name)[1].lower() in extensions
+    )
+
+
+def update_user_records(folder, results):
+    # Point each user's image_path at the re-encoded file
+    moved = {
+        os.path.realpath(r['path']): r['new_path']
+        for r in results if r['new_path'] != r['path']
+    }
+    if not moved:
+        return 0
+    registry = UserRegistry(folder=folder)
+    registry.load_all()
+    updated = 0
+    for username, record in registry.items():
+        new_path = moved.get(os.path.realpath(record.get('image_path', '')))
+        if new_path is not None:
+            registry.update(username, dict(record, image_path=new_path))
+            updated += 1
+    return updated
+
+
+def report(results, failures):
+    if not results:
+        print('No files migrated.')
+    else:
+        before = sum(r['bytes_before'] for r in results)
+        after = sum(r['bytes_after'] for r in results)
+        decode_before = np.array([r['decode_ms_before'] for r in results])
+        decode_after = np.array([r['decode_ms_after'] for r in results])
+        print(f'Files migrated: {len(results)}')
+        print(f'Disk: {before / 1024:.1f} KiB -> {after / 1024:.1f} KiB '
+              f'({(after - before) / before:+.1%})')
+        print(f'Decode to comparison array: mean {decode_before.mean():.3f} ms -> {decode_after.mean():.3f} ms, '
+              f'p95 {np.percentile(decode_before, 95):.3f} ms -> {np.percentile(decode_after, 95):.3f} ms')
+    for path, error in failures:
+        print(f'FAILED {path}: {error}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Re-encode enrollment images to a new format')
+    parser.add_argument('--uploads', default='uploads', help='Folder holding enrollment images')
+    parser.add_argument('--users', default='users', help='Folder holding user records to update')
+    parser.add_argument('--format', default='PNG', choices=sorted(enrollment.FORMATS))
+    parser.add_argument('--size', type=int, default=TEMPLATE_SHAPE[0], help='Square size; 0 keeps the original size')
+    parser.add_argument('--quality', type=int, default=enrollment.DEFAULT_SPEC['quality'])
+    parser.add_argument('--keep-original', action='store_true', help='Copy originals to the cold folder first')
+    parser.add_argument('--cold-folder', default=enrollment.DEFAULT_SPEC['cold_folder'])
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--dry-run', action='store_true', help='Only measure; do not write anything')
+    args = parser.parse_args()
+
+    spec = enrollment.resolve_spec({
+        'format': args.format,
+        'size': args.size or None,
+        'quality': args.quality,
+        'keep_original': args.keep_original,
+        'cold_folder': args.cold_folder,
+    })
+    paths = find_uploads(args.uploads)
+    print(f'Migrating {len(paths)} files to {spec["format"]} '
+          f'{spec["size"] or "original size"} with {args.workers} workers'
+          f'{" (dry run)" if args.dry_run else ""}')
+
+    results, failures = [], []
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(migrate_file, path, spec, args.dry_run): path for path in paths}
+        for future, path in futures.items():
+            try:
+                results.append(future.result())
+            except Exception as e:
+                failures.append((path, e))
+    report(results, failures)
+    if not args.dry_run:
+        print(f'User records updated: {update_user_records(args.users, results)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+# Cheap frame-quality gate run before any full-resolution image work.
+#
+# JPEG frames are decoded straight to a small grayscale copy through PIL's
+# draft mode (DCT scaling), so the gate never materializes the full frame.
+# There is no face detector here: "no face" means the centre of the frame,
+# where the capture UI frames the face, has almost no structure.
+
+ANALYSIS_SIZE = (160, 120)
+
+DEFAULT_THRESHOLDS = {
+    'min_luminance': 40,      # mean gray level, 0-255
+    'max_luminance': 220,
+    'min_contrast': 12,       # gray level standard deviation
+    'min_sharpness': 60,      # variance of the Laplacian at ANALYSIS_SIZE
+    'min_center_contrast': 8,
+}
+
+MESSAGES = {
+    'unreadable': 'Could not read the captured image. Please capture again.',
+    'too_dark': 'Image is too dark. Please improve the lighting and try again.',
+    'too_bright': 'Image is overexposed. Please reduce the lighting or move away from bright light.',
+    'low_contrast': 'Image has too little contrast. Please make sure the camera is not covered.',
+    'too_blurry': 'Image is too blurry. Please hold still and try again.',
+    'no_face': 'No face detected. Please center your face in the camera.',
+}
+
+
+def analysis_frame(image_bytes, size=ANALYSIS_SIZE):
+    image = Image.open(BytesIO(image_bytes))
+    image.draft('L', size)
+    image = image.convert('L')
+    if image.width > size[0] or image.height > size[1]:
+        image.thumbnail(size, Image.NEAREST)
+    return np.asarray(image, dtype=np.float32)
+
+
+def frame_metrics(gray):
+    laplacian = (
+        gray[1:-1, :-2] + gray[1:-1, 2:] + gray[:-2, 1:-1] + gray[2:, 1:-1]
+        - 4 * gray[1:-1, 1:-1]
+    )
+    height, width = gray.shape
+    center = gray[height // 4:height - height // 4, width // 4:width - width // 4]
+    return {
+        'luminance': float(gray.mean()),
+        'contrast': float(gray.std()),
+        'sharpness': float(laplacian.var()),
+        'center_contrast': float(center.std()),
+    }
+
+
+def check_frame(image_bytes, thresholds=None):
+    """Return (reason, message) for an unusable frame, or None if it is usable."""
+    limits = dict(DEFAULT_THRESHOLDS, **(thresholds or {}))
+    try:
+        metrics = frame_metrics(analysis_frame(image_bytes))
+    except Exception:
+        return 'unreadable', MESSAGES['unreadable']
+
+    if metrics['luminance'] < limits['min_luminance']:
+        reason = 'too_dark'
+    elif metrics['luminance'] > limits['max_luminance']:
+        reason = 'too_bright'
+    elif metrics['contrast'] < limits['min_contrast']:
+        reason = 'low_contrast'
+    elif metrics['sharpness'] < limits['min_sharpness']:
+        reason = 'too_blurry'
+    elif metrics['center_contrast'] < limits['min_center_contrast']:
+        reason = 'no_face'
+    else:
+        return None
+    return reason, MESSAGES[reason]
@@ -0,0 +1,147 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from werkzeug.security import generate_password_hash
+
+from user_registry import UserRegistry
+
+# Concurrency stress check and signup throughput benchmark for UserRegistry.
+#
+#   python registry_stress.py            # stress checks, then benchmark
+#   python registry_stress.py --bench-only
+
+
+def run_threads(count, target):
+    barrier = threading.Barrier(count)
+
+    def runner(thread_id):
+        barrier.wait()
+        target(thread_id)
+
+    threads = [threading.Thread(target=runner, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def stress_registry(threads, names, rounds):
+    # Every thread races to claim every name; each name must end up with
+    # exactly one owner and that owner's record.
+    for _ in range(rounds):
+        registry = UserRegistry(stripes=8)
+        wins = {}
+        wins_lock = threading.Lock()
+
+        def claim_all(thread_id):
+            order = [f'user{i}' for i in range(names)]
+            random.Random(thread_id).shuffle(order)
+            for name in order:
+                if registry.reserve(name):
+                    try:
+                        registry.commit(name, {'owner': thread_id})
+                    finally:
+                        registry.release(name)
+                    with wins_lock:
+                        wins.setdefault(name, []).append(thread_id)
+
+        run_threads(threads, claim_all)
+        assert len(registry) == names, f'{len(registry)} users registered, expected {names}'
+        for name, owners in wins.items():
+            assert len(owners) == 1, f'{name} claimed by {owners}'
+            assert registry[name]['owner'] == owners[0], f'{name} holds a loser\'s record'
+    print(f'registry: {rounds} rounds x {threads} threads x {names} names OK')
+
+
+def stress_signup(threads, rounds):
+    # Concurrent /signup requests for one username with different faces:
+    # exactly one succeeds and the stored template is the winner's face.
+    workdir = tempfile.mkdtemp(prefix='registry_stress_')
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import numpy as np
+    import dev
+    from loadtest import generate_face, to_data_url
+
+    faces = [to_data_url(generate_face(i)) for i in range(threads)]
+    expected = [dev.normalize_image(dev.Image.open(dev.BytesIO(dev.decode_data_url(face)))) for face in faces]
+
+    for round_number in range(rounds):
+        username = f'race{round_number}'
+        results = [None] * threads
+
+        def signup(thread_id):
+            client = dev.app.test_client()
+            response = client.post('/signup', data={
+                'username': username,
+                'password': 'secret',
+                'confirm_password': 'secret',
+                'email': 'race@example.com',
+                'image': faces[thread_id],
+            })
+            results[thread_id] = response.get_json()['success']
+
+        run_threads(threads, signup)
+        winners = [i for i, ok in enumerate(results) if ok]
+        assert len(winners) == 1, f'{username}: {len(winners)} signups succeeded'
+        stored = dev.template_store.get(username)
+        assert stored.shape[0] == 1, f'{username}: {stored.shape[0]} templates stored'
+        assert np.array_equal(stored[0], expected[winners[0]]), f'{username}: face was overwritten'
+    print(f'signup: {rounds} rounds x {threads} concurrent signups OK ({workdir})')
+
+
+def bench(thread_counts, signups_per_thread):
+    # Signup-shaped work: reserve, hash the password outside any lock, commit.
+    # The coarse-lock row holds one global lock across the whole signup.
+    def registry_signup(registry, name):
+        if registry.reserve(name):
+            try:
+                registry.commit(name, {'password': generate_password_hash('secret')})
+            finally:
+                registry.release(name)
+
+    coarse_lock = threading.Lock()
+
+    def coarse_signup(registry, name):
+        with coarse_lock:
+            registry.insert_if_absent(name, {'password': generate_password_hash('secret')})
+
+    print(f'\n{"threads":>8} {"registry/s":>12} {"coarse lock/s":>14}')
+    for count in thread_counts:
+        row = []
+        for signup in (registry_signup, coarse_signup):
+            registry = UserRegistry()
+
+            def worker(thread_id):
+                for i in range(signups_per_thread):
+                    signup(registry, f't{thread_id}-u{i}')
+
+            start = time.perf_counter()
+            run_threads(count, worker)
+            row.append(count * signups_per_thread / (time.perf_counter() - start))
+        print(f'{count:>8} {row[0]:>12.1f} {row[1]:>14.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='UserRegistry stress test and signup benchmark')
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--names', type=int, default=500)
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--bench-threads', default='1,2,4,8,16')
+    parser.add_argument('--signups-per-thread', type=int, default=8)
+    parser.add_argument('--bench-only', action='store_true')
+    args = parser.parse_args()
+
+    if not args.bench_only:
+        stress_registry(args.threads, args.names, args.rounds)
+        stress_signup(args.threads, max(1, args.rounds // 4))
+    bench([int(n) for n in args.bench_threads.split(',')], args.signups_per_thread)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+def payload_digest(data):
+    # Digest of the raw data URL, taken before any base64 or image decoding
+    if isinstance(data, str):
+        data = data.encode('ascii', 'surrogateescape')
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class ResultCache:
+    """Bounded TTL + LRU cache of face-comparison verdicts.
+
+    Keys are (username, payload digest, template version), so a retry or
+    double-click that resends the same frame gets the earlier verdict
+    without decoding anything, and re-enrolling a face (new template
+    version) never reuses an old verdict. Each entry is a small tuple, so
+    `max_entries` bounds memory at roughly 200 bytes per entry.
+    """
+
+    def __init__(self, max_entries=4096, ttl=120):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_user(self, username):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == username]:
+                del self._entries[key]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
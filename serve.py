@@ -0,0 +1,221 @@
+import argparse
+import gc
+import os
+import random
+import signal
+import socket
+import sys
+import time
+
+from werkzeug.serving import ThreadedWSGIServer
+
+# Production launcher: a master process imports and preloads the app once,
+# then forks worker processes that share the preloaded data copy-on-write
+# and accept connections on one listening socket.
+#
+#   SIGHUP           replace all workers one by one (graceful reload; code
+#                    preloaded in the master is not re-imported)
+#   SIGTERM/SIGINT   let workers finish their current request, then exit
+#   SIGTTIN/SIGTTOU  add/remove one worker
+#
+# Workers serve each connection on its own thread and exit after
+# --max-requests (plus jitter) so slow leaks are recycled. The app's
+# admission limits are shared by all workers, so logins beyond the global
+# in-flight and queue budget get an immediate 503 instead of waiting in the
+# listen backlog. POSIX only: relies on os.fork().
+
+
+class TimeoutAwareServer(ThreadedWSGIServer):
+    timeout_handled = False
+    # server_close() waits for requests still running on other threads
+    daemon_threads = False
+    block_on_close = True
+
+    def handle_timeout(self):
+        self.timeout_handled = True
+
+
+class Worker:
+    def __init__(self, app, sock, options, on_exit=None):
+        self.app = app
+        self.sock = sock
+        self.options = options
+        self.on_exit = on_exit
+        self.stopping = False
+        self.handled = 0
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+
+        host, port = self.sock.getsockname()[:2]
+        server = TimeoutAwareServer(host, port, self.app, fd=self.sock.fileno())
+        server.timeout = 0.5
+        max_requests = self.options.max_requests
+        if max_requests:
+            max_requests += random.randint(0, self.options.max_requests_jitter)
+
+        # handle_request() returns after one request or the timeout, which
+        # lets the loop notice a stop signal between requests
+        while not self.stopping:
+            server.handle_request()
+            if server.timeout_handled:
+                server.timeout_handled = False
+            else:
+                self.handled += 1
+            if max_requests and self.handled >= max_requests:
+                break
+            if os.getppid() != self.options.master_pid:
+                break  # master died
+        server.server_close()
+        # os._exit() skips atexit, so flush buffered state explicitly
+        if self.on_exit is not None:
+            self.on_exit()
+        os._exit(0)
+
+    def stop(self, signum, frame):
+        self.stopping = True
+
+
+class Master:
+    def __init__(self, app, options, on_exit=None, on_reap=None):
+        self.app = app
+        self.options = options
+        self.on_exit = on_exit
+        self.on_reap = on_reap
+        self.workers = {}  # pid -> spawn time
+        self.target = options.workers
+        self.stopping = False
+        self.reload_requested = False
+
+    def listen(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.options.host, self.options.port))
+        sock.listen(self.options.backlog)
+        sock.set_inheritable(True)
+        return sock
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = time.time()
+            return pid
+        try:
+            Worker(self.app, self.sock, self.options, self.on_exit).run()
+        finally:
+            os._exit(1)
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            self.workers.pop(pid, None)
+            # A worker killed mid-request cannot release shared state itself
+            if self.on_reap is not None:
+                self.on_reap(pid)
+
+    def kill_worker(self, pid, sig=signal.SIGTERM):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            self.workers.pop(pid, None)
+
+    def reload(self):
+        # Start a fresh worker before stopping each old one so capacity
+        # never drops below the target
+        old = list(self.workers)
+        for pid in old:
+            self.spawn()
+            self.kill_worker(pid)
+            deadline = time.time() + self.options.graceful_timeout
+            while pid in self.workers and time.time() < deadline:
+                time.sleep(0.05)
+                self.reap()
+            if pid in self.workers:
+                self.kill_worker(pid, signal.SIGKILL)
+
+    def install_signals(self):
+        def stop(signum, frame):
+            self.stopping = True
+
+        def hup(signum, frame):
+            self.reload_requested = True
+
+        def more(signum, frame):
+            self.target += 1
+
+        def fewer(signum, frame):
+            self.target = max(1, self.target - 1)
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGHUP, hup)
+        signal.signal(signal.SIGTTIN, more)
+        signal.signal(signal.SIGTTOU, fewer)
+
+    def run(self):
+        self.sock = self.listen()
+        self.options.master_pid = os.getpid()
+        self.install_signals()
+
+        # Everything allocated so far is shared with workers; keep the
+        # cyclic GC from touching (and so un-sharing) those pages later
+        gc.collect()
+        gc.freeze()
+
+        print(f'Master {os.getpid()} listening on http://{self.options.host}:{self.options.port} '
+              f'with {self.target} workers', flush=True)
+        while not self.stopping:
+            self.reap()
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+            while len(self.workers) < self.target:
+                self.spawn()
+            if len(self.workers) > self.target:
+                self.kill_worker(next(iter(self.workers)))
+            time.sleep(0.1)
+        self.shutdown()
+
+    def shutdown(self):
+        for pid in list(self.workers):
+            self.kill_worker(pid)
+        deadline = time.time() + self.options.graceful_timeout
+        while self.workers and time.time() < deadline:
+            self.reap()
+            time.sleep(0.05)
+        for pid in list(self.workers):
+            self.kill_worker(pid, signal.SIGKILL)
+        self.reap()
+        self.sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run Smart-Login with preforked workers')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--max-requests', type=int, default=10000, help='Recycle a worker after this many requests; 0 disables')
+    parser.add_argument('--max-requests-jitter', type=int, default=1000)
+    parser.add_argument('--graceful-timeout', type=float, default=30.0)
+    parser.add_argument('--backlog', type=int, default=2048)
+    options = parser.parse_args()
+
+    if not hasattr(os, 'fork'):
+        sys.exit('serve.py needs os.fork(); use "python dev.py" on this platform')
+
+    import dev
+    dev.write_templates()
+    dev.preload()
+    dev.admission.share_between_processes()
+    Master(dev.app, options, on_exit=dev.shutdown, on_reap=dev.admission.release_process).run()
+
+
+if __name__ == '__main__':
+    main()
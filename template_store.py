@@ -0,0 +1,358 @@
+import argparse
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process locking only
+    fcntl = None
+
+# Normalized comparison array used by compare_images()
+TEMPLATE_SHAPE = (256, 256, 3)
+
+
+class TemplateStore:
+    """Append-only, memory-mapped matrix of every user's comparison template.
+
+    All templates live back to back in one raw data file so that any
+    population-wide operation is a single mmap instead of N file opens and
+    N JPEG decodes. A user owns a contiguous block of one or more records
+    (a gallery). An index log next to it gets one JSON line per change,
+    mapping a username to (first slot, count, version), so writers append a
+    line instead of rewriting the index and readers only apply the lines
+    they have not seen. Changing a gallery appends a new block and leaves
+    the old one dead until compact() rewrites the live records into a
+    fresh data file and index log, named by a small JSON header.
+    Readers in other worker processes map the same file and therefore share
+    its pages through the OS page cache.
+    """
+
+    def __init__(self, directory, shape=TEMPLATE_SHAPE, dtype=np.uint8):
+        self.directory = directory
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.record_size = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.index_path = os.path.join(directory, 'index.json')
+        self.lock_path = os.path.join(directory, '.lock')
+
+        self._lock = threading.RLock()
+        self._index_stamp = None
+        self._data_file = None
+        self._log_file = None
+        self._log_offset = 0
+        self._generation = 0
+        self._records = {}
+        self._matrix = None
+        self._mapped_file = None
+
+        os.makedirs(directory, exist_ok=True)
+        with self._exclusive():
+            if not os.path.exists(self.index_path):
+                self._data_file = 'templates.0.bin'
+                self._log_file = 'index.0.log'
+                open(self._data_path(), 'ab').close()
+                open(self._log_path(), 'ab').close()
+                self._write_index()
+        self._refresh()
+
+    def _data_path(self, name=None):
+        return os.path.join(self.directory, name or self._data_file)
+
+    def _log_path(self, name=None):
+        return os.path.join(self.directory, name or self._log_file)
+
+    @contextmanager
+    def _exclusive(self):
+        # Serializes writers across threads and, where available, processes
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self.lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _write_index(self):
+        # Header only; records live in the index log
+        index = {
+            'shape': list(self.shape),
+            'dtype': self.dtype.str,
+            'generation': self._generation,
+            'data_file': self._data_file,
+            'log_file': self._log_file,
+        }
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+        self._index_stamp = self._stamp()
+
+    def _stamp(self):
+        stat = os.stat(self.index_path)
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _refresh(self):
+        # Pick up appends and compactions made by other processes. A new
+        # header means a compaction and a fresh log; otherwise only the lines
+        # appended since the last refresh are read.
+        while True:
+            stamp = self._stamp()
+            if stamp != self._index_stamp:
+                self._read_header(stamp)
+            try:
+                self._read_log()
+                return
+            except FileNotFoundError:
+                # Compacted between the header and the log read
+                if self._stamp() == stamp:
+                    raise
+
+    def _read_header(self, stamp):
+        with open(self.index_path, encoding='utf-8') as f:
+            index = json.load(f)
+        if tuple(index['shape']) != self.shape or np.dtype(index['dtype']) != self.dtype:
+            raise ValueError(f"Template store {self.directory} holds {index['dtype']}{index['shape']} records")
+        self._generation = index['generation']
+        self._data_file = index['data_file']
+        self._log_file = index['log_file']
+        self._log_offset = 0
+        self._records = {}
+        self._index_stamp = stamp
+
+    def _read_log(self):
+        path = self._log_path()
+        size = os.path.getsize(path)
+        if size <= self._log_offset:
+            return
+        with open(path, 'rb') as f:
+            f.seek(self._log_offset)
+            tail = f.read(size - self._log_offset)
+        # A line without its newline is still being written
+        end = tail.rfind(b'\n') + 1
+        for line in tail[:end].splitlines():
+            name, *entry = json.loads(line)
+            if entry:
+                self._records[name] = tuple(entry)
+            else:
+                self._records.pop(name, None)
+        self._log_offset += end
+
+    def _log(self, username, *entry):
+        # Caller holds _exclusive() and has refreshed, so the log ends at
+        # _log_offset; an entry-less line records a deletion
+        line = (json.dumps([username, *entry]) + '\n').encode('ascii')
+        with open(self._log_path(), 'ab') as f:
+            f.write(line)
+        self._log_offset += len(line)
+
+    def _mapped(self, rows_needed):
+        # Remap when the data file was swapped or grew past the current view
+        if (
+            self._matrix is None
+            or self._mapped_file != self._data_file
+            or self._matrix.shape[0] < rows_needed
+        ):
+            rows = os.path.getsize(self._data_path()) // self.record_size
+            if rows == 0:
+                self._matrix = np.empty((0,) + self.shape, dtype=self.dtype)
+            else:
+                self._matrix = np.memmap(
+                    self._data_path(), dtype=self.dtype, mode='r', shape=(rows,) + self.shape
+                )
+            self._mapped_file = self._data_file
+        return self._matrix
+
+    def __contains__(self, username):
+        with self._lock:
+            self._refresh()
+            return username in self._records
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return len(self._records)
+
+    def _block(self, entry):
+        slot, count = entry[0], entry[1]
+        return self._mapped(slot + count)[slot:slot + count]
+
+    def get(self, username):
+        """Return a read-only (K, H, W, C) view of the user's gallery, or None."""
+        with self._lock:
+            self._refresh()
+            entry = self._records.get(username)
+            if entry is None:
+                return None
+            return self._block(entry)
+
+    def version(self, username):
+        with self._lock:
+            self._refresh()
+            entry = self._records.get(username)
+            return entry[2] if entry else None
+
+    def put(self, username, templates):
+        """Replace the user's gallery with one (H, W, C) or several (K, H, W, C)
+        templates and return its new version."""
+        templates = np.ascontiguousarray(templates, dtype=self.dtype)
+        if templates.shape == self.shape:
+            templates = templates[np.newaxis]
+        if templates.shape[1:] != self.shape or not len(templates):
+            raise ValueError(f'Expected templates of shape (K,) + {self.shape}, got {templates.shape}')
+
+        with self._exclusive():
+            self._refresh()
+            return self._append(username, templates)
+
+    def _append(self, username, templates):
+        # Caller holds _exclusive()
+        with open(self._data_path(), 'ab') as f:
+            slot = f.tell() // self.record_size
+            f.write(templates.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        previous = self._records.get(username)
+        version = previous[2] + 1 if previous else 1
+        self._records[username] = (slot, len(templates), version)
+        self._log(username, *self._records[username])
+        return version
+
+    def add(self, username, template, max_templates=None):
+        """Add a template to the user's gallery, keeping the newest
+        `max_templates`, and return the new version.
+
+        The whole gallery is rewritten as one block so get() stays a
+        zero-copy slice of the map.
+        """
+        template = np.asarray(template, dtype=self.dtype)
+        if template.shape != self.shape:
+            raise ValueError(f'Expected template of shape {self.shape}, got {template.shape}')
+
+        with self._exclusive():
+            self._refresh()
+            entry = self._records.get(username)
+            templates = template[np.newaxis]
+            if entry is not None:
+                templates = np.concatenate([self._block(entry), templates])
+            if max_templates:
+                templates = templates[-max_templates:]
+            return self._append(username, np.ascontiguousarray(templates))
+
+    def delete(self, username):
+        with self._exclusive():
+            self._refresh()
+            if self._records.pop(username, None) is not None:
+                self._log(username)
+
+    def _live_slots(self):
+        ordered = sorted(self._records.items(), key=lambda item: item[1][0])
+        owners, slots = [], []
+        for name, (slot, count, _) in ordered:
+            owners.extend([name] * count)
+            slots.extend(range(slot, slot + count))
+        return ordered, owners, slots
+
+    def snapshot(self):
+        """Return (owners, matrix) for population-wide operations.
+
+        Row i of the (N, H, W, C) matrix belongs to owners[i]. The matrix is
+        a memmap when no dead records sit between live ones, and a gathered
+        copy otherwise.
+        """
+        with self._lock:
+            self._refresh()
+            _, owners, slots = self._live_slots()
+            matrix = self._mapped(slots[-1] + 1 if slots else 0)
+            if slots == list(range(len(slots))):
+                return owners, matrix[:len(slots)]
+            return owners, matrix[slots]
+
+    def preload(self):
+        """Map the data file and ask the OS to read it into the page cache.
+
+        Unlike snapshot() nothing is copied, so a forking server can call it
+        before fork and every worker starts from the same warm mapping.
+        """
+        with self._lock:
+            self._refresh()
+            self._mapped(0)
+            path = self._data_path()
+        if hasattr(os, 'posix_fadvise'):
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+
+    def stats(self):
+        with self._lock:
+            self._refresh()
+            total = os.path.getsize(self._data_path()) // self.record_size
+            live = sum(entry[1] for entry in self._records.values())
+            return {
+                'live_records': live,
+                'dead_records': total - live,
+                'data_bytes': total * self.record_size,
+                'index_bytes': self._log_offset,
+                'generation': self._generation,
+            }
+
+    def compact(self):
+        """Rewrite live records into a new data file and index log, dropping
+        dead slots and superseded log lines."""
+        with self._exclusive():
+            self._refresh()
+            ordered, _, slots = self._live_slots()
+            old_file, old_log = self._data_file, self._log_file
+            old_matrix = self._mapped(slots[-1] + 1 if slots else 0)
+
+            new_file = f'templates.{self._generation + 1}.bin'
+            with open(self._data_path(new_file), 'wb') as f:
+                records = {}
+                new_slot = 0
+                for name, (slot, count, version) in ordered:
+                    f.write(old_matrix[slot:slot + count].tobytes())
+                    records[name] = (new_slot, count, version)
+                    new_slot += count
+                f.flush()
+                os.fsync(f.fileno())
+
+            new_log = f'index.{self._generation + 1}.log'
+            with open(self._log_path(new_log), 'wb') as f:
+                for name, entry in records.items():
+                    f.write((json.dumps([name, *entry]) + '\n').encode('ascii'))
+                self._log_offset = f.tell()
+
+            # Swap the header last so readers never see new slots on old data
+            self._generation += 1
+            self._data_file = new_file
+            self._log_file = new_log
+            self._records = records
+            self._matrix = None
+            self._write_index()
+
+            # Processes still mapping the old file keep its inode alive
+            for path in (self._data_path(old_file), self._log_path(old_log)):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inspect or compact a template store')
+    parser.add_argument('command', choices=['stats', 'compact'])
+    parser.add_argument('--dir', default='template_store', help='Template store directory')
+    args = parser.parse_args()
+
+    store = TemplateStore(args.dir)
+    if args.command == 'compact':
+        store.compact()
+    print(json.dumps(store.stats(), indent=2))
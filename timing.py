@@ -0,0 +1,86 @@
+import json
+import logging
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+
+import allocations
+
+# Per-stage request timing, exposed as a Server-Timing header and a
+# structured log line. Stages accumulate, so a stage entered twice in one
+# request (e.g. two image decodes) reports the total.
+
+logger = logging.getLogger('smartlogin.timing')
+
+STAGES = {
+    'form': 'Form parsing',
+    'queue': 'Admission queue wait',
+    'b64': 'Base64 decode',
+    'quality': 'Frame quality gate',
+    'decode': 'Image decode and resize',
+    'similarity': 'Similarity computation',
+    'encode': 'Enrollment image encode',
+    'hash': 'Password hashing',
+    'storage': 'Storage',
+}
+
+
+@contextmanager
+def timed(stage):
+    if not has_request_context():
+        yield
+        return
+    start = time.perf_counter_ns()
+    try:
+        if allocations.tracker is None:
+            yield
+        else:
+            with allocations.stage(stage):
+                yield
+    finally:
+        elapsed = time.perf_counter_ns() - start
+        timings = g.setdefault('timings', {})
+        timings[stage] = timings.get(stage, 0) + elapsed
+
+
+def server_timing_header(timings, total_ns):
+    parts = [
+        f'{stage};desc="{STAGES.get(stage, stage)}";dur={elapsed / 1e6:.3f}'
+        for stage, elapsed in timings.items()
+    ]
+    parts.append(f'total;dur={total_ns / 1e6:.3f}')
+    return ', '.join(parts)
+
+
+def init_app(app, endpoints):
+    log_path = app.config.get('TIMING_LOG')
+    if not logger.handlers:
+        handler = logging.FileHandler(log_path) if log_path else logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+
+    @app.before_request
+    def start_request_timer():
+        if request.endpoint in endpoints:
+            g.request_start_ns = time.perf_counter_ns()
+
+    @app.after_request
+    def add_server_timing(response):
+        start = g.get('request_start_ns')
+        if start is None:
+            return response
+        total = time.perf_counter_ns() - start
+        timings = g.get('timings', {})
+        response.headers['Server-Timing'] = server_timing_header(timings, total)
+        logger.info(json.dumps({
+            'event': 'request_timing',
+            'endpoint': request.endpoint,
+            'method': request.method,
+            'status': response.status_code,
+            'total_ms': round(total / 1e6, 3),
+            'stages_ms': {stage: round(elapsed / 1e6, 3) for stage, elapsed in timings.items()},
+        }))
+        return response
@@ -0,0 +1,131 @@
+import hashlib
+import os
+import secrets
+import threading
+import time
+
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+
+class RevocationSet:
+    """Ids of tokens revoked before they expired.
+
+    An id only needs remembering until its token would have expired anyway,
+    so entries are evicted by TTL and the set stays as small as the number
+    of recent logouts. It lives in process memory and only spares the
+    worker that handled the logout a record read; other workers see the
+    revocation through the user's device epoch.
+    """
+
+    def __init__(self, sweep_interval=60):
+        self._expiry = {}
+        self._lock = threading.Lock()
+        self._sweep_interval = sweep_interval
+        self._next_sweep = 0
+
+    def add(self, token_id, expires_at):
+        now = time.time()
+        with self._lock:
+            self._expiry[token_id] = expires_at
+            if now >= self._next_sweep:
+                self._expiry = {tid: exp for tid, exp in self._expiry.items() if exp > now}
+                self._next_sweep = now + self._sweep_interval
+
+    def __contains__(self, token_id):
+        expires_at = self._expiry.get(token_id)
+        return expires_at is not None and expires_at > time.time()
+
+    def __len__(self):
+        return len(self._expiry)
+
+
+class SingleUseIds:
+    """Ids that can be claimed once across every process sharing `folder`.
+
+    claim() creates a marker file with O_EXCL, which is atomic across
+    processes, unlike anything kept in a worker's memory or in the
+    client-side session. Markers older than `ttl` are swept, since their
+    ids have expired by then anyway.
+    """
+
+    def __init__(self, folder, ttl, sweep_interval=60):
+        self.folder = folder
+        self.ttl = ttl
+        self._sweep_interval = sweep_interval
+        self._next_sweep = 0
+        os.makedirs(folder, exist_ok=True)
+
+    def claim(self, token_id):
+        # Ids come from signed payloads; hashing keeps them safe as file names
+        name = hashlib.sha256(token_id.encode('utf-8')).hexdigest()
+        try:
+            fd = os.open(os.path.join(self.folder, name), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        os.close(fd)
+        self._sweep()
+        return True
+
+    def _sweep(self):
+        now = time.time()
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self._sweep_interval
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            try:
+                if os.path.getmtime(path) < now - self.ttl:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+class TrustedDevices:
+    """Signed, expiring tokens that let a device skip face verification.
+
+    A token names the user, the template version and the user's device
+    epoch it was issued against, so re-enrolling a face or bumping the epoch
+    in the shared user record invalidates every outstanding token in every
+    worker process.
+    """
+
+    def __init__(self, secret_key):
+        self.serializer = URLSafeTimedSerializer(secret_key, salt='trusted-device')
+        self.revoked = RevocationSet()
+
+    @staticmethod
+    def cookie_name(username):
+        # One cookie per user so a shared workstation can trust several users
+        return 'trusted_device_' + hashlib.sha256(username.encode('utf-8')).hexdigest()[:16]
+
+    def issue(self, username, template_version, device_epoch):
+        return self.serializer.dumps({
+            'u': username,
+            'id': secrets.token_urlsafe(12),
+            'v': template_version,
+            'e': device_epoch,
+        })
+
+    def _load(self, token, window):
+        try:
+            payload, issued_at = self.serializer.loads(token, max_age=window, return_timestamp=True)
+        except BadSignature:  # also covers expired tokens
+            return None, None
+        return payload, issued_at.timestamp() + window
+
+    def verify(self, token, username, template_version, device_epoch, window):
+        if not token or window <= 0:
+            return False
+        payload, _ = self._load(token, window)
+        return (
+            payload is not None
+            and payload.get('u') == username
+            and payload.get('v') == template_version
+            and payload.get('e') == device_epoch
+            and payload.get('id') not in self.revoked
+        )
+
+    def revoke(self, token, window):
+        payload, expires_at = self._load(token, window)
+        if payload is not None:
+            self.revoked.add(payload['id'], expires_at)
@@ -0,0 +1,164 @@
+import hashlib
+import json
+import os
+import threading
+
+# Sentinel stored while a signup is in progress
+_PENDING = object()
+
+
+class UserRegistry:
+    """Thread-safe username -> user record map for a threaded server.
+
+    Writers take one of `stripes` locks chosen by username hash, so signups
+    for different users rarely contend. Reads take no lock: a single dict
+    lookup is atomic. A signup first reserve()s its username, does the slow
+    work (image save, password hashing) outside any lock, then commit()s;
+    a concurrent signup for the same name fails at reserve() instead of
+    overwriting the first user's face.
+
+    With a `folder`, every user is also a JSON file there so that several
+    worker processes see the same users. The file is created with O_EXCL at
+    reserve() time, which makes the reservation atomic across processes, and
+    filled in at commit(). Users committed by another process are read on a
+    cache miss. Files are named by a hash of the username, so any two
+    distinct names get distinct files; the real name is kept inside.
+    """
+
+    def __init__(self, stripes=64, folder=None):
+        self._stripes = [threading.Lock() for _ in range(stripes)]
+        self._records = {}
+        self.folder = folder
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+    def _lock_for(self, username):
+        return self._stripes[hash(username) % len(self._stripes)]
+
+    def _path_for(self, username):
+        digest = hashlib.sha256(username.encode('utf-8')).hexdigest()
+        return os.path.join(self.folder, f'{digest}.json')
+
+    def _read(self, username):
+        try:
+            with open(self._path_for(username), encoding='utf-8') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if not data:
+            return None  # reserved, not committed yet
+        entry = json.loads(data)
+        return entry['record'] if entry['username'] == username else None
+
+    def get(self, username, default=None):
+        record = self._records.get(username)
+        if record is None and self.folder:
+            record = self._read(username)
+            if record is not None:
+                self._records.setdefault(username, record)
+        if record is None or record is _PENDING:
+            return default
+        return record
+
+    def reload(self, username):
+        """Return the user's record as currently stored, re-reading its file.
+
+        For fields another worker process may have changed since this one
+        cached the record.
+        """
+        if not self.folder:
+            return self.get(username)
+        record = self._read(username)
+        if record is not None:
+            with self._lock_for(username):
+                if self._records.get(username) is not _PENDING:
+                    self._records[username] = record
+        return record
+
+    def __getitem__(self, username):
+        record = self.get(username)
+        if record is None:
+            raise KeyError(username)
+        return record
+
+    def __contains__(self, username):
+        return self.get(username) is not None
+
+    def __len__(self):
+        return sum(1 for record in list(self._records.values()) if record is not _PENDING)
+
+    def items(self):
+        """Committed (username, record) pairs currently in memory."""
+        return [(name, record) for name, record in list(self._records.items()) if record is not _PENDING]
+
+    def insert_if_absent(self, username, record):
+        """Insert record unless username is taken or reserved; return True if inserted."""
+        with self._lock_for(username):
+            if username in self._records:
+                return False
+            if self.folder:
+                try:
+                    fd = os.open(self._path_for(username), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                except FileExistsError:
+                    return False
+                os.close(fd)
+                if record is not _PENDING:
+                    self._write(username, record)
+            self._records[username] = record
+            return True
+
+    def _write(self, username, record):
+        path = self._path_for(username)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'username': username, 'record': record}, f)
+        os.replace(tmp_path, path)
+
+    def reserve(self, username):
+        return self.insert_if_absent(username, _PENDING)
+
+    def commit(self, username, record):
+        with self._lock_for(username):
+            if self._records.get(username) is not _PENDING:
+                raise KeyError(f'{username} is not reserved')
+            if self.folder:
+                self._write(username, record)
+            self._records[username] = record
+
+    def update(self, username, record):
+        """Replace the record of a committed user."""
+        with self._lock_for(username):
+            if self.get(username) is None:
+                raise KeyError(username)
+            if self.folder:
+                self._write(username, record)
+            self._records[username] = record
+
+    def release(self, username):
+        # Drop a reservation that was never committed; committed users stay
+        with self._lock_for(username):
+            if self._records.get(username) is _PENDING:
+                del self._records[username]
+                if self.folder:
+                    os.remove(self._path_for(username))
+
+    def load_all(self):
+        """Read every committed user into memory and drop stale reservations.
+
+        Meant for a master process before it forks workers: the loaded
+        records are then shared copy-on-write.
+        """
+        if not self.folder:
+            return 0
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            if not name.endswith('.json'):
+                continue
+            with open(path, encoding='utf-8') as f:
+                data = f.read()
+            if not data:
+                os.remove(path)  # left behind by a signup that never finished
+                continue
+            entry = json.loads(data)
+            self._records[entry['username']] = entry['record']
+        return len(self)